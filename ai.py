@@ -1,13 +1,22 @@
-from langchain_core.messages import AIMessage, SystemMessage, HumanMessage
+from langchain_core.messages import AIMessage, AIMessageChunk, SystemMessage, HumanMessage
 from langgraph.prebuilt import create_react_agent
 from langchain_community.chat_models import ChatOpenAI # Keep if still using, otherwise can remove
 from langchain_community.tools.tavily_search import TavilySearchResults
-from langchain_together import ChatTogether
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_groq import ChatGroq
 import os
+import time
+import asyncio
 from dotenv import load_dotenv
 import datetime # Import datetime for the utcnow() fix (though not used directly in ai.py)
+from llm_registry import llm_registry
+from cache import response_cache, response_cache_key, LLM_CACHE_ENABLED
+from similarity_cache import similarity_cache, SIMILARITY_CACHE_ENABLED
+from context import context_budget, truncate_to_tokens
+from scheduler import scheduler, INTERACTIVE, FUSION
+from breaker import provider_health, CircuitOpen
+from metrics import metrics
+from deadline import Deadline, DeadlineExceeded, deadline_scope, within_deadline, iterate_within_deadline, \
+    capped, remaining, current_deadline
+from langgraph.errors import GraphRecursionError
 
 load_dotenv()
 
@@ -17,23 +26,80 @@ GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 TOGETHER_API_KEY = os.environ.get("TOGETHER_API_KEY")
 
 
-groq_llm = ChatGroq(model="llama-3.3-70b-versatile")
-gemini_llm = ChatGoogleGenerativeAI(model='gemini-2.0-flash')
-together_llm = ChatTogether(model="mistralai/Mixtral-8x7B-Instruct-v0.1")
+system_prompt_default = "Act as AI chatbot who is smart and friendly"
 
+# Hedging: the same request goes to an equivalent model on another provider when the first is slow or down
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "0") == "1"
+HEDGE_FALLBACKS = {
+    "Groq": ("Gemini", "gemini-2.0-flash"),
+    "TogetherAI": ("Groq", "llama-3.3-70b-versatile"),
+    "Gemini": ("Groq", "llama-3.3-70b-versatile"),
+}
+# Hedge delay until a provider has enough latency samples for a p95, and the floor under it
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", "8"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "1"))
 
-system_prompt_default = "Act as AI chatbot who is smart and friendly"
+# Under a request deadline the agent gets about one step per AGENT_STEP_SECONDS left, within these bounds
+AGENT_STEP_SECONDS = float(os.environ.get("AGENT_STEP_SECONDS", "4"))
+AGENT_MIN_STEPS = 3
+AGENT_MAX_STEPS = 25
+# A web search round is skipped when less than this is left; the model answers from what it knows
+SEARCH_MIN_SECONDS = float(os.environ.get("SEARCH_MIN_SECONDS", "10"))
+# Appended when a stream is cut off by the request deadline
+DEADLINE_NOTE = "\n\n_(Answer cut short: the time limit for this request was reached.)_"
 
-def get_respoonse(model_name: str, messages: list, allow_search: bool, system_prompt: str, provider: str):
-    if provider == 'Groq':
-        llm = ChatGroq(model=model_name)
-    elif provider == 'Gemini':
-        llm = ChatGoogleGenerativeAI(model=model_name)
-    elif provider == 'TogetherAI':
-        llm = ChatTogether(model=model_name)
-    else:
-        raise ValueError(f"Unsupported provider: {provider}")
+LLM_CALL_SECONDS = metrics.histogram("llm_call_seconds", "Provider call latency, from getting a scheduler slot",
+                                     ("provider", "model", "kind", "outcome"))
+LLM_FIRST_TOKEN_SECONDS = metrics.histogram("llm_first_token_seconds", "Time to the first streamed token",
+                                            ("provider", "model", "kind"))
+# Stage is a candidate provider, "fusion" (the merge call) or "total"
+FUSION_STAGE_SECONDS = metrics.histogram("fusion_stage_seconds", "White-Fusion fan-out and merge timings",
+                                         ("stage", "status"))
+FUSION_PROMPT_CHARS = metrics.histogram("fusion_prompt_chars", "Length of the White-Fusion merge prompt",
+                                        buckets=(1000, 2000, 4000, 8000, 16000, 32000, 64000))
+
+def observe_call(provider: str, model_name: str, kind: str, outcome: str, started):
+    # Calls that never got a slot have no latency to report
+    if started is not None:
+        LLM_CALL_SECONDS.labels(provider, model_name, kind, outcome).observe(time.perf_counter() - started)
+
+# Answers that used web search go stale sooner than plain completions
+LLM_CACHE_SEARCH_TTL = float(os.environ.get("LLM_CACHE_SEARCH_TTL", "300"))
 
+def cache_keys_for(model_name: str, langchain_messages: list, allow_search: bool, system_prompt: str, provider: str):
+    """Return (exact key, similarity key); either is None when its cache layer is off or does not apply.
+
+    The similarity key is (partition, MinHash signature of the last user message); the system
+    prompt and everything before that message have to match exactly through the partition hash,
+    so a long shared system prompt (or document excerpts in it) can't make different questions look alike.
+    """
+    exact_key = similar_key = None
+    if LLM_CACHE_ENABLED:
+        exact_key = response_cache_key(provider, model_name, system_prompt,
+                                       [(m.type, m.content) for m in langchain_messages], allow_search)
+    if (SIMILARITY_CACHE_ENABLED and langchain_messages and isinstance(langchain_messages[-1], HumanMessage)
+            and isinstance(langchain_messages[-1].content, str)):
+        partition = response_cache_key(provider, model_name, system_prompt,
+                                       [(m.type, m.content) for m in langchain_messages[:-1]], allow_search)
+        similar_key = (partition, similarity_cache.sign(langchain_messages[-1].content))
+    return exact_key, similar_key
+
+async def cached_answer(cache_keys):
+    exact_key, similar_key = cache_keys
+    answer = await response_cache.get(exact_key) if exact_key else None
+    if answer is None and similar_key:
+        answer = similarity_cache.get_signed(*similar_key)
+    return answer
+
+async def remember_answer(cache_keys, answer: str, allow_search: bool):
+    exact_key, similar_key = cache_keys
+    ttl = LLM_CACHE_SEARCH_TTL if allow_search else None
+    if exact_key:
+        await response_cache.set(exact_key, answer, ttl=ttl)
+    if similar_key:
+        similarity_cache.set_signed(*similar_key, answer, ttl=ttl)
+
+def to_langchain_messages(messages: list):
     # Ensure all messages are Langchain message objects
     langchain_messages = []
     for msg in messages:
@@ -65,96 +131,507 @@ def get_respoonse(model_name: str, messages: list, allow_search: bool, system_pr
             else:
                 # If it's truly an unsupported type without role/content, raise an error
                 raise TypeError(f"Unsupported message object type: {type(msg)}. Content: {msg}")
+    return langchain_messages
+
+def direct_prompt_messages(langchain_messages: list, allow_search: bool, system_prompt: str):
+    """Return the messages for a plain model call, or None when the ReAct agent is needed."""
+    is_simple_direct_prompt = (
+        not allow_search and
+        len(langchain_messages) <= 2 and
+        all(isinstance(m, (HumanMessage, SystemMessage)) for m in langchain_messages)
+    )
+    if not is_simple_direct_prompt:
+        return None
 
+    final_messages_for_direct_invoke = []
+    if system_prompt and not any(isinstance(m, SystemMessage) for m in langchain_messages):
+        final_messages_for_direct_invoke.append(SystemMessage(content=system_prompt))
+    final_messages_for_direct_invoke.extend(langchain_messages)
+    return final_messages_for_direct_invoke
+
+def agent_config():
+    """LangGraph run config whose step limit fits the time the current request has left."""
+    left = remaining()
+    steps = AGENT_MAX_STEPS if left is None else int(left / AGENT_STEP_SECONDS)
+    return {"recursion_limit": max(AGENT_MIN_STEPS, min(steps, AGENT_MAX_STEPS))}
+
+def search_allowed(allow_search: bool):
+    left = remaining()
+    return allow_search and (left is None or left >= SEARCH_MIN_SECONDS)
+
+def build_agent(llm, langchain_messages: list, allow_search: bool, system_prompt: str):
+    chat_msgs = [SystemMessage(content=system_prompt)]
+    chat_msgs.extend(langchain_messages)
+
+    tools = [TavilySearchResults(max_results=2)] if allow_search else []
+    agent = create_react_agent(model=llm, tools=tools)
+    return agent, {"messages": chat_msgs}
+
+def call_kind(direct_messages, allow_search: bool):
+    # Latency differs by an order of magnitude between these, so each gets its own percentiles
+    if direct_messages is not None:
+        return "direct"
+    return "search" if allow_search else "agent"
+
+async def invoke_provider(provider: str, model_name: str, langchain_messages: list, allow_search: bool,
+                          system_prompt: str, lane: str):
+    """Make one call to `provider`: fails fast with CircuitOpen while its breaker is open and reports the outcome."""
+    llm = llm_registry.get(provider, model_name)
+    allow_search = search_allowed(allow_search)
+    direct_messages = direct_prompt_messages(langchain_messages, allow_search, system_prompt)
+    kind = call_kind(direct_messages, allow_search)
+    provider_health.check(provider)
+    started = None
     try:
-        is_simple_direct_prompt = (
-            not allow_search and
-            len(langchain_messages) <= 2 and
-            all(isinstance(m, (HumanMessage, SystemMessage)) for m in langchain_messages)
-        )
+        async with scheduler.slot(provider, lane):
+            started = time.perf_counter()
+            if direct_messages is not None:
+                response = await llm.ainvoke(direct_messages)
+                answer = response.content
+            else:
+                agent, agent_input = build_agent(llm, langchain_messages, allow_search, system_prompt)
+                response = await agent.ainvoke(agent_input, config=agent_config())
+                ai_messages = [msg.content for msg in response.get("messages", []) if isinstance(msg, AIMessage)]
+                answer = ai_messages[-1] if ai_messages else ""
+    except asyncio.CancelledError:
+        provider_health.abandon(provider)
+        observe_call(provider, model_name, kind, "cancelled", started)
+        raise
+    except GraphRecursionError:
+        if current_deadline.get() is None:
+            # No deadline, so the limit was AGENT_MAX_STEPS: the agent looped, which is a plain failure
+            provider_health.record(provider, kind, False, time.perf_counter() - started)
+            observe_call(provider, model_name, kind, "error", started)
+            raise
+        # Out of agent steps for the time left: the request's budget, not the provider, is at fault
+        provider_health.abandon(provider)
+        observe_call(provider, model_name, kind, "deadline", started)
+        raise DeadlineExceeded()
+    except Exception:
+        provider_health.record(provider, kind, False, time.perf_counter() - (started or time.perf_counter()))
+        observe_call(provider, model_name, kind, "error", started)
+        raise
+    provider_health.record(provider, kind, True, time.perf_counter() - started)
+    observe_call(provider, model_name, kind, "ok", started)
+    return answer
+
+async def hedged_invoke(provider: str, model_name: str, langchain_messages: list, allow_search: bool,
+                        system_prompt: str, lane: str, hedge: bool):
+    """Return (answer, provider that answered).
 
-        if is_simple_direct_prompt:
-            final_messages_for_direct_invoke = []
-            if system_prompt and not any(isinstance(m, SystemMessage) for m in langchain_messages):
-                final_messages_for_direct_invoke.append(SystemMessage(content=system_prompt))
-            final_messages_for_direct_invoke.extend(langchain_messages)
-            
-            response = llm.invoke(final_messages_for_direct_invoke)
-            return {"response": response.content}
-        
-        chat_msgs = [SystemMessage(content=system_prompt)]
-        chat_msgs.extend(langchain_messages)
-
-        tools = [TavilySearchResults(max_results=2)] if allow_search else []
-        agent = create_react_agent(model=llm, tools=tools)
-        response = agent.invoke({"messages": chat_msgs})
-        
-        ai_messages = [msg.content for msg in response.get("messages", []) if isinstance(msg, AIMessage)]
-        return {"response": ai_messages[-1] if ai_messages else ""}
+    With hedging on, a provider that fails, or hasn't answered within its own p95 for this kind of
+    call, gets raced against the same request to its fallback provider; the first answer wins.
+    """
+    fallback = HEDGE_FALLBACKS.get(provider) if hedge and HEDGE_ENABLED else None
+    primary = asyncio.create_task(
+        invoke_provider(provider, model_name, langchain_messages, allow_search, system_prompt, lane))
+    if fallback is None:
+        return await primary, provider
 
+    kind = call_kind(direct_prompt_messages(langchain_messages, allow_search, system_prompt), allow_search)
+    delay = max(provider_health.p95(provider, kind) or HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY)
+    tasks = {primary: provider}
+    try:
+        await asyncio.wait({primary}, timeout=delay)
+        if not primary.done() or primary.exception() is not None:
+            fallback_provider, fallback_model = fallback
+            provider_health.counters["hedged" if not primary.done() else "failed_over"] += 1
+            tasks[asyncio.create_task(invoke_provider(
+                fallback_provider, fallback_model, langchain_messages, allow_search, system_prompt,
+                lane))] = fallback_provider
+
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if tasks[task] != provider:
+                        provider_health.counters["fallback_answers"] += 1
+                    return task.result(), tasks[task]
+                # Prefer reporting the primary's own error
+                if error is None or tasks[task] == provider:
+                    error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def get_respoonse(model_name: str, messages: list, allow_search: bool, system_prompt: str, provider: str,
+                        use_cache: bool = True, lane: str = INTERACTIVE, hedge: bool = True):
+    llm_registry.get(provider, model_name)
+    langchain_messages = to_langchain_messages(messages)
+
+    cache_keys = (None, None)
+    if use_cache:
+        cache_keys = cache_keys_for(model_name, langchain_messages, allow_search, system_prompt, provider)
+        cached = await cached_answer(cache_keys)
+        if cached is not None:
+            return {"response": cached, "cached": True}
+    else:
+        response_cache.record_bypass()
+
+    try:
+        answer, answered_by = await within_deadline(hedged_invoke(
+            provider, model_name, langchain_messages, allow_search, system_prompt, lane, hedge))
+
+        if answered_by != provider:
+            # Not cached: the key names the model that was asked, not the one that answered
+            return {"response": answer, "answered_by": answered_by}
+        if isinstance(answer, str) and answer:
+            await remember_answer(cache_keys, answer, allow_search)
+        return {"response": answer}
+
+    except DeadlineExceeded:
+        print(f"Deadline reached in get_respoonse ({provider}, {model_name})")
+        return {"response": f"{provider} did not answer in time.", "failed": True, "deadline_exceeded": True}
+    except CircuitOpen as e:
+        print(f"Skipped get_respoonse ({provider}, {model_name}): circuit open for {e.retry_after:.0f}s more")
+        return {"response": f"{provider} is temporarily unavailable, please try again shortly.", "failed": True}
     except Exception as e:
         print(f"Error in get_respoonse ({provider}, {model_name}): {str(e)}")
         import traceback
         traceback.print_exc()
-        return {"response": f"{provider} failed: {str(e)}"}
+        return {"response": f"{provider} failed: {str(e)}", "failed": True}
 
 
-def get_head_model_response(messages, allow_search, system_prompt):
+async def stream_provider(provider: str, model_name: str, langchain_messages: list, allow_search: bool,
+                          system_prompt: str, lane: str):
+    """Streaming counterpart of invoke_provider; the outcome is reported once the stream ends."""
+    llm = llm_registry.get(provider, model_name)
+    allow_search = search_allowed(allow_search)
+    direct_messages = direct_prompt_messages(langchain_messages, allow_search, system_prompt)
+    kind = call_kind(direct_messages, allow_search)
+    provider_health.check(provider)
+    started = None
+    first_token = LLM_FIRST_TOKEN_SECONDS.labels(provider, model_name, kind)
     try:
-        trimmed_messages = messages[-4:]
-
-        def safe_response(name, model, provider):
-            try:
-                resp = get_respoonse(model, trimmed_messages, allow_search, system_prompt, provider)
-                if isinstance(resp, dict):
-                    text = resp.get("response", "")
-                    return text[:1200] if text else f"{name} returned no answer."
-                else:
-                    return f"{name} gave unexpected format."
-            except Exception as e:
-                return f"{name} failed: {str(e)}"
+        async with scheduler.slot(provider, lane):
+            started = time.perf_counter()
+            if direct_messages is not None:
+                async for chunk in llm.astream(direct_messages):
+                    if isinstance(chunk.content, str) and chunk.content:
+                        if first_token is not None:
+                            first_token.observe(time.perf_counter() - started)
+                            first_token = None
+                        yield chunk.content
+            else:
+                agent, agent_input = build_agent(llm, langchain_messages, allow_search, system_prompt)
+                # "messages" mode emits LLM tokens from inside the graph; tool output is skipped.
+                async for chunk, metadata in agent.astream(agent_input, stream_mode="messages",
+                                                           config=agent_config()):
+                    if metadata.get("langgraph_node") != "agent" or not isinstance(chunk, AIMessageChunk):
+                        continue
+                    if isinstance(chunk.content, str) and chunk.content:
+                        if first_token is not None:
+                            first_token.observe(time.perf_counter() - started)
+                            first_token = None
+                        yield chunk.content
+    except (asyncio.CancelledError, GeneratorExit):
+        provider_health.abandon(provider)
+        observe_call(provider, model_name, kind, "cancelled", started)
+        raise
+    except GraphRecursionError:
+        if current_deadline.get() is None:
+            provider_health.record(provider, kind, False, time.perf_counter() - started)
+            observe_call(provider, model_name, kind, "error", started)
+            raise
+        provider_health.abandon(provider)
+        observe_call(provider, model_name, kind, "deadline", started)
+        raise DeadlineExceeded()
+    except Exception:
+        provider_health.record(provider, kind, False, time.perf_counter() - (started or time.perf_counter()))
+        observe_call(provider, model_name, kind, "error", started)
+        raise
+    provider_health.record(provider, kind, True, time.perf_counter() - started)
+    observe_call(provider, model_name, kind, "ok", started)
+
+
+async def stream_respoonse(model_name: str, messages: list, allow_search: bool, system_prompt: str, provider: str,
+                           use_cache: bool = True, lane: str = INTERACTIVE, hedge: bool = True):
+    """Yield the answer as text chunks in the order the provider produces them.
+
+    A cached answer is yielded as a single chunk; a fresh one is cached once the stream completes.
+    Streams are not hedged, but with hedging on a provider whose breaker is open is swapped for
+    its fallback before the stream starts. A stream the request deadline cuts off ends with
+    DEADLINE_NOTE, or raises DeadlineExceeded if nothing had arrived yet.
+    """
+    llm_registry.get(provider, model_name)
+    langchain_messages = to_langchain_messages(messages)
+
+    cache_keys = (None, None)
+    if use_cache:
+        cache_keys = cache_keys_for(model_name, langchain_messages, allow_search, system_prompt, provider)
+        cached = await cached_answer(cache_keys)
+        if cached is not None:
+            yield cached
+            return
+    else:
+        response_cache.record_bypass()
+
+    fallback = HEDGE_FALLBACKS.get(provider) if hedge and HEDGE_ENABLED else None
+    answered_by = provider
+    if fallback is not None and provider_health.is_open(provider):
+        provider_health.counters["failed_over"] += 1
+        provider_health.counters["fallback_answers"] += 1
+        answered_by, model_name = fallback
+
+    parts = []
+    try:
+        async for chunk in iterate_within_deadline(stream_provider(
+                answered_by, model_name, langchain_messages, allow_search, system_prompt, lane)):
+            parts.append(chunk)
+            yield chunk
+    except DeadlineExceeded:
+        if not parts:
+            raise
+        yield DEADLINE_NOTE
+        return
 
-        groq_resp = safe_response("Groq", "llama-3.3-70b-versatile", "Groq")
-        together_resp = safe_response("Together", "mistralai/Mixtral-8x7B-Instruct-v0.1", "TogetherAI")
-        gemini_resp = safe_response("Gemini", "gemini-2.0-flash", "Gemini")
+    if parts and answered_by == provider:
+        await remember_answer(cache_keys, "".join(parts), allow_search)
 
-        history_text = "\n".join(
-            f"{msg['role'].capitalize()}: {msg['content']}" if isinstance(msg, dict)
-            else f"{msg.role.capitalize()}: {msg.content}"
-            for msg in trimmed_messages if msg
-        )[:1500]
 
-        combined_prompt = f"""
+SUMMARY_MODEL = ("Gemini", "gemini-2.0-flash")
+SUMMARY_TIMEOUT = float(os.environ.get("SUMMARY_TIMEOUT", "15"))
+
+async def summarize_turns(summary: str, turns_text: str, max_words: int):
+    """Fold `turns_text` into the running `summary`; returns None when the model call failed."""
+    prompt = f"""
+Current summary of the conversation:
+{summary or "(empty)"}
+
+New turns:
+{turns_text}
+
+Rewrite the summary so it also covers the new turns. Keep facts, names, numbers, decisions and open questions. Use at most {max_words} words and respond only with the summary.
+""".strip()
+    provider, model_name = SUMMARY_MODEL
+    # The summary is only a means to the answer, so it may use a third of the time left at most
+    with deadline_scope(Deadline(min(SUMMARY_TIMEOUT, remaining(SUMMARY_TIMEOUT * 3) / 3))):
+        resp = await get_respoonse(model_name, [{"role": "user", "content": prompt}], False,
+                                   "You maintain a running summary of a conversation.", provider)
+    if resp.get("failed") or not resp.get("response"):
+        return None
+    return resp["response"].strip()
+
+
+FUSION_CANDIDATES = [
+    ("Groq", "llama-3.3-70b-versatile", "Groq"),
+    ("Together", "mistralai/Mixtral-8x7B-Instruct-v0.1", "TogetherAI"),
+    ("Gemini", "gemini-2.0-flash", "Gemini"),
+]
+FUSION_PROVIDER_TIMEOUT = float(os.environ.get("FUSION_PROVIDER_TIMEOUT", "30"))
+FUSION_QUORUM = int(os.environ.get("FUSION_QUORUM", str(len(FUSION_CANDIDATES))))
+# Callers fit the history to the smallest candidate window before fanning out
+FUSION_CONTEXT_BUDGET = min(context_budget(model) for _, model, _ in FUSION_CANDIDATES)
+# Size of the merge prompt: a quarter for the conversation tail, the rest shared by the answers
+FUSION_MERGE_TOKENS = int(os.environ.get("FUSION_MERGE_TOKENS", "2000"))
+FUSION_HISTORY_TOKENS = FUSION_MERGE_TOKENS // 4
+FUSION_ANSWER_TOKENS = (FUSION_MERGE_TOKENS - FUSION_HISTORY_TOKENS) // len(FUSION_CANDIDATES)
+# Under a request deadline the fan-out stops early enough to leave this much (at most a third of the
+# time left) for the merge call; with less than FUSION_MERGE_MIN_SECONDS left the first candidate
+# answer is returned unmerged.
+FUSION_MERGE_RESERVE = float(os.environ.get("FUSION_MERGE_RESERVE", "10"))
+FUSION_MERGE_MIN_SECONDS = float(os.environ.get("FUSION_MERGE_MIN_SECONDS", "3"))
+
+
+async def collect_fusion_prompt(messages, allow_search, system_prompt, quorum=None, provider_timeout=None,
+                                use_cache=True):
+    """Fan the turn out to every fusion candidate and build the merge prompt from the answers.
+
+    Candidates whose circuit breaker is open are left out up front rather than waited on.
+    Returns (merge prompt, timings, first good answer or None).
+    """
+    candidates = [candidate for candidate in FUSION_CANDIDATES if not provider_health.is_open(candidate[2])]
+    quorum = min(quorum or FUSION_QUORUM, len(candidates))
+    provider_timeout = provider_timeout or FUSION_PROVIDER_TIMEOUT
+
+    async def safe_response(name, model, provider):
+        started = time.perf_counter()
+        try:
+            # Not hedged: a fallback would just repeat another candidate's provider
+            resp = await get_respoonse(model, messages, allow_search, system_prompt, provider, use_cache, FUSION,
+                                       hedge=False)
+            if isinstance(resp, dict):
+                text = resp.get("response", "")
+                ok = bool(text) and not resp.get("failed")
+                return (text or f"{name} returned no answer."), ok, time.perf_counter() - started
+            else:
+                return f"{name} gave unexpected format.", False, time.perf_counter() - started
+        except Exception as e:
+            return f"{name} failed: {str(e)}", False, time.perf_counter() - started
+
+    fan_out_started = time.perf_counter()
+    tasks = {
+        asyncio.create_task(safe_response(name, model, provider)): (name, provider)
+        for name, model, provider in candidates
+    }
+    answers = {}
+    timings = {candidate[2]: {"seconds": 0.0, "status": "circuit_open"}
+               for candidate in FUSION_CANDIDATES if candidate not in candidates}
+    answered = 0
+    first_answer = None
+    pending = set(tasks)
+    left = remaining()
+    reserve = FUSION_MERGE_RESERVE if left is None else min(FUSION_MERGE_RESERVE, left / 3)
+    fan_out_deadline = fan_out_started + capped(provider_timeout, reserve=reserve)
+
+    # Stop waiting as soon as the quorum has answered or the per-provider timeout runs out.
+    while pending and answered < quorum:
+        time_left = fan_out_deadline - time.perf_counter()
+        if time_left <= 0:
+            break
+        done, pending = await asyncio.wait(pending, timeout=time_left, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            name, provider = tasks[task]
+            text, ok, elapsed = task.result()
+            answers[provider] = truncate_to_tokens(text, FUSION_ANSWER_TOKENS)
+            timings[provider] = {"seconds": round(elapsed, 3), "status": "ok" if ok else "failed"}
+            if ok:
+                answered += 1
+                first_answer = first_answer or text
+
+    for task in pending:
+        task.cancel()
+        name, provider = tasks[task]
+        timings[provider] = {"seconds": round(time.perf_counter() - fan_out_started, 3), "status": "skipped"}
+
+    history_text = truncate_to_tokens("\n".join(
+        f"{msg['role'].capitalize()}: {msg['content']}" if isinstance(msg, dict)
+        else f"{msg.role.capitalize()}: {msg.content}"
+        for msg in messages if msg
+    ), FUSION_HISTORY_TOKENS, keep_end=True)
+
+    candidates_text = "\n\n".join(
+        f"{provider} said:\n{answers[provider]}"
+        for name, model, provider in FUSION_CANDIDATES if provider in answers
+    )
+
+    combined_prompt = f"""
 You are a smart AI that combines responses from multiple AI models into one accurate, helpful answer.
 
 Conversation so far:
 {history_text}
 
-Groq said:
-{groq_resp}
+{candidates_text}
+
+Now, write the best combined response.
+""".strip()
 
-TogetherAI said:
-{together_resp}
+    FUSION_PROMPT_CHARS.observe(len(combined_prompt))
+    return combined_prompt, timings, first_answer
 
-Gemini said:
-{gemini_resp}
 
-Now, write the best combined response.
-""".strip()[:4000]
+def merge_time_left():
+    left = remaining()
+    return left is None or left >= FUSION_MERGE_MIN_SECONDS
 
-        print("Fusion prompt length:", len(combined_prompt))
 
-        fused = get_respoonse(
+def single_candidate():
+    """(model, provider) to answer alone when the fan-out brought back nothing to merge."""
+    for _, model, provider in FUSION_CANDIDATES:
+        if not provider_health.is_open(provider):
+            return model, provider
+    # All open: ask anyway, and the caller gets the provider's "temporarily unavailable" answer
+    return FUSION_CANDIDATES[-1][1:]
+
+
+def finish_timings(timings: dict, fan_out_started: float):
+    """Add the total to a fusion turn's timings and record every stage."""
+    timings["total"] = {"seconds": round(time.perf_counter() - fan_out_started, 3),
+                        "status": timings.get("fusion", {}).get("status", "ok")}
+    for stage, timing in timings.items():
+        FUSION_STAGE_SECONDS.labels(stage, timing["status"]).observe(timing["seconds"])
+
+
+async def get_head_model_response(messages, allow_search, system_prompt, quorum=None, provider_timeout=None,
+                                  use_cache=True):
+    try:
+        fan_out_started = time.perf_counter()
+        combined_prompt, timings, first_answer = await collect_fusion_prompt(
+            messages, allow_search, system_prompt, quorum, provider_timeout, use_cache)
+
+        if first_answer is None:
+            # No candidate answered (all failed, timed out or circuit-open): one model answers the turn itself
+            single_started = time.perf_counter()
+            model, provider = single_candidate()
+            single = await get_respoonse(model, messages, allow_search, system_prompt, provider, use_cache)
+            timings["fusion"] = {"seconds": round(time.perf_counter() - single_started, 3),
+                                 "status": "single_failed" if single.get("failed") else "single"}
+            finish_timings(timings, fan_out_started)
+            return {"response": single.get("response", "⚠️ No fusion response."), "timings": timings}
+
+        if not merge_time_left():
+            timings["fusion"] = {"seconds": 0.0, "status": "skipped"}
+            finish_timings(timings, fan_out_started)
+            return {"response": first_answer, "timings": timings}
+
+        fusion_started = time.perf_counter()
+        fused = await get_respoonse(
             "gemini-2.0-flash",
             [{"role": "user", "content": combined_prompt}],
             False,
             system_prompt,
-            "Gemini"
+            "Gemini",
+            use_cache
         )
+        timings["fusion"] = {"seconds": round(time.perf_counter() - fusion_started, 3),
+                             "status": "failed" if isinstance(fused, dict) and fused.get("failed") else "ok"}
+        finish_timings(timings, fan_out_started)
+        if isinstance(fused, dict) and fused.get("deadline_exceeded"):
+            # Out of time mid-merge: one candidate's answer beats none
+            return {"response": first_answer, "timings": timings}
 
         if isinstance(fused, dict):
-            return {"response": fused.get("response", "⚠️ No fusion response.")}
-        return {"response": str(fused)}
+            return {"response": fused.get("response", "⚠️ No fusion response."), "timings": timings}
+        return {"response": str(fused), "timings": timings}
 
     except Exception as e:
-        return {"response": f"⚠️ Fusion Error: {str(e)}"}
\ No newline at end of file
+        return {"response": f"⚠️ Fusion Error: {str(e)}"}
+
+
+async def stream_head_model_response(messages, allow_search, system_prompt, quorum=None, provider_timeout=None, timings=None,
+                                     use_cache=True):
+    """Like get_head_model_response, but streams the merge call; per-stage timings are written into `timings`."""
+    timings = timings if timings is not None else {}
+    fan_out_started = time.perf_counter()
+    combined_prompt, candidate_timings, first_answer = await collect_fusion_prompt(
+        messages, allow_search, system_prompt, quorum, provider_timeout, use_cache)
+    timings.update(candidate_timings)
+
+    if first_answer is None:
+        single_started = time.perf_counter()
+        model, provider = single_candidate()
+        async for chunk in stream_respoonse(model, messages, allow_search, system_prompt, provider, use_cache):
+            yield chunk
+        timings["fusion"] = {"seconds": round(time.perf_counter() - single_started, 3), "status": "single"}
+        finish_timings(timings, fan_out_started)
+        return
+
+    if not merge_time_left():
+        timings["fusion"] = {"seconds": 0.0, "status": "skipped"}
+        finish_timings(timings, fan_out_started)
+        yield first_answer
+        return
+
+    fusion_started = time.perf_counter()
+    try:
+        async for chunk in stream_respoonse(
+            "gemini-2.0-flash",
+            [{"role": "user", "content": combined_prompt}],
+            False,
+            system_prompt,
+            "Gemini",
+            use_cache
+        ):
+            yield chunk
+    except DeadlineExceeded:
+        # Nothing of the merge arrived in time
+        timings["fusion"] = {"seconds": round(time.perf_counter() - fusion_started, 3), "status": "timeout"}
+        finish_timings(timings, fan_out_started)
+        yield first_answer
+        return
+    timings["fusion"] = {"seconds": round(time.perf_counter() - fusion_started, 3), "status": "ok"}
+    finish_timings(timings, fan_out_started)
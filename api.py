@@ -3,27 +3,44 @@ from datetime import datetime, timedelta
 import models
 import schemas
 from schemas import Message, RequestState
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Body
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Body, Query, Header, Response, BackgroundTasks
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from models import User, Chat, UploadedFile, OTP
-from database import get_db, SessionLocal, engine, Base
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, func, tuple_, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
+from models import User, Chat, ChatMessage, UploadedFile, OTP, IngestionJob, ExtractionCache
+from chat_store import append_messages, split_messages, bump_history_version, new_upload_chat, new_uploaded_file
+from database import get_async_db, AsyncSessionLocal, async_engine, engine, Base
 import uvicorn
 from typing import List, Optional
-from auth import SECRET_KEY, ALGORITHM, create_access_token, verify_password, get_password_hash
+from auth import SECRET_KEY, ALGORITHM, create_access_token, \
+    CurrentUser, user_cache, invalidate_user, TRUST_TOKEN_USER_ID, password_hasher, PasswordHasherBusy
 from jose import jwt, JWTError
-from ai import get_respoonse, get_head_model_response
+from ai import get_respoonse, get_head_model_response, stream_respoonse, stream_head_model_response, \
+    summarize_turns, FUSION_CONTEXT_BUDGET
+from context import build_context, context_budget
+from retrieval import retrieve, format_excerpts
+from search import search_chats
+from llm_registry import llm_registry
+from cache import response_cache
+from similarity_cache import similarity_cache
+from mailer import mail_queue, MailQueueFull
+from ratelimit import rate_limiter, request_weight, RateLimited
+from scheduler import scheduler, BACKGROUND
+from breaker import provider_health
+from deadline import Deadline, deadline_scope, current_deadline
+from metrics import metrics, RequestMetricsMiddleware, CONTENT_TYPE
 from pydantic import BaseModel
 from typing import Literal
-import fitz
-from PIL import Image
-import pytesseract
-import pytesseract
-
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 # filepath: d:\testing\api.py
-import io
+import json
+import base64
+import asyncio
+import hashlib
+import anyio
 
 Base.metadata.create_all(bind=engine)
 
@@ -35,41 +52,89 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestMetricsMiddleware)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-def get_db_session():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+@app.on_event("startup")
+async def warm_up_llm_clients():
+    await llm_registry.warm_up()
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await llm_registry.close()
+
+@app.on_event("startup")
+async def start_mail_queue():
+    mail_queue.start()
+
+@app.on_event("shutdown")
+async def stop_mail_queue():
+    # Gives queued OTPs a few seconds to go out
+    await run_in_threadpool(mail_queue.stop)
+
+@app.on_event("shutdown")
+async def stop_password_hasher():
+    password_hasher.shutdown()
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db_session)):
+@app.on_event("shutdown")
+async def close_db_pool():
+    await async_engine.dispose()
+
+get_db_session = get_async_db
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db_session)):
+    """Resolve the bearer token to a CurrentUser: a signature check plus, at most, a cache lookup."""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Could not validate credentials")
-        user = db.query(User).filter(User.username == username).first()
-        if user is None:
-            raise HTTPException(status_code=401, detail="Could not validate credentials")
-        return user
     except JWTError:
         raise HTTPException(status_code=401, detail="Could not validate credentials")
+    username: str = payload.get("sub")
+    if username is None:
+        raise HTTPException(status_code=401, detail="Could not validate credentials")
+
+    if TRUST_TOKEN_USER_ID and isinstance(payload.get("uid"), int):
+        return CurrentUser(id=payload["uid"], username=username)
+
+    # Tokens from before the uid claim, or uid not trusted: look the username up once per TTL
+    user = user_cache.get(username)
+    if user is None:
+        user_id = await db.scalar(select(User.id).where(User.username == username))
+        if user_id is None:
+            raise HTTPException(status_code=401, detail="Could not validate credentials")
+        user = CurrentUser(id=user_id, username=username)
+        user_cache.set(username, user)
+    return user
+
+def password_hasher_busy():
+    return HTTPException(status_code=503, detail="Too many sign-ins at once, please retry.",
+                         headers={"Retry-After": "1"})
+
+async def hash_password(password: str):
+    try:
+        return await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        raise password_hasher_busy()
+
+def queue_otp_mail(email: str, otp: str):
+    try:
+        auth.send_mail(email, otp)
+    except MailQueueFull:
+        raise HTTPException(status_code=503, detail="Too many verification emails pending, please retry.",
+                            headers={"Retry-After": "5"})
 
 @app.post("/signup")
-def signup(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db_session)):
-    user = db.query(User).filter(User.username == form.username).first()
+async def signup(form: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db_session)):
+    user = await db.scalar(select(User).where(User.username == form.username))
     if user:
         raise HTTPException(status_code=400, detail="Username already registered")
 
+    # Hash first: if the hasher turns us away, no code has been mailed for an OTP that was never stored
+    hashed_pw = await hash_password(form.password)
+
     otp = auth.generate_otp(form.username)
-    auth.send_mail(form.username, otp)
     expires = datetime.utcnow() + timedelta(minutes=5)
 
-    hashed_pw = get_password_hash(form.password)
-
     otp_entry = models.OTP(
         email=form.username,
         otp=otp,
@@ -77,20 +142,31 @@ def signup(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(ge
         password=hashed_pw
     )
     db.add(otp_entry)
-    db.commit()
+    await db.commit()
+    queue_otp_mail(form.username, otp)
 
     return {"message": "OTP sent to your email."}
 
 @app.post("/login")
-def login(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db_session)):
-    user = db.query(User).filter(User.username == form.username).first()
-    if not user or not verify_password(form.password, user.password):
+async def login(form: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db_session)):
+    user = await db.scalar(select(User).where(User.username == form.username))
+    if not user:
         raise HTTPException(status_code=400, detail="Invalid credentials")
-    access_token = create_access_token(data={"sub": user.username})
+    try:
+        valid, new_hash = await password_hasher.verify(form.password, user.password)
+    except PasswordHasherBusy:
+        raise password_hasher_busy()
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+    if new_hash:
+        # Stored at another bcrypt cost; upgrade it now that we have the plain password
+        user.password = new_hash
+        await db.commit()
+    access_token = create_access_token(data={"sub": user.username, "uid": user.id})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/verify-token")
-def verify_token(payload: dict = Body(...), db: Session = Depends(get_db_session)):
+def verify_token(payload: dict = Body(...)):
     token = payload.get("token")
     try:
         jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -102,27 +178,34 @@ class ChatMessagePayload(BaseModel):
     message: str
     chat_id: Optional[int] = None
 
-async def call_llm_for_title_generation(first_message_content: str) -> str:
+async def call_llm_for_title_generation(first_message_content: str) -> Optional[str]:
+    """Return a generated title, or None to keep the provisional one."""
     try:
         clean_message = first_message_content.replace("User:", "").strip()
         
         if not clean_message:
-            return "New Chat"
+            return None
 
         title_prompt_messages = [
             {"role": "system", "content": "You are a title generation assistant. Summarize the following user input into a concise, 5-10 word title. Do not include quotes or special characters. Respond only with the title."},
             {"role": "user", "content": clean_message}
         ]
         
-        response_obj = get_respoonse(
+        response_obj = await get_respoonse(
             model_name="gemini-2.0-flash",
             messages=title_prompt_messages,
             allow_search=False,
             system_prompt="Generate a concise chat title.",
-            provider="Gemini"
+            provider="Gemini",
+            lane=BACKGROUND
         )
         
-        generated_title = response_obj.get("response", "New Chat").strip()
+        # A failed call's response is an error message ("Gemini failed: ..."), not a title
+        if response_obj.get("failed"):
+            return None
+        generated_title = (response_obj.get("response") or "").strip()
+        if not generated_title:
+            return None
 
         if len(generated_title.split()) > 10:
             generated_title = " ".join(generated_title.split()[:10]) + "..."
@@ -132,72 +215,190 @@ async def call_llm_for_title_generation(first_message_content: str) -> str:
     except Exception as e:
         # In a production environment, you might log this error instead of printing
         print(f"Error generating title with LLM: {e}")
+        return None
+
+def provisional_chat_title(first_message_content: str) -> str:
+    words = first_message_content.replace("User:", "").split()
+    if not words:
         return "New Chat"
+    title = " ".join(words[:6])
+    return title[:50] + ("..." if len(words) > 6 or len(title) > 50 else "")
+
+async def generate_chat_title(chat_id: int, user_id: int, provisional_title: str, first_message_content: str):
+    generated_title = await call_llm_for_title_generation(first_message_content)
+    if not generated_title or generated_title == provisional_title:
+        return
+    try:
+        async with AsyncSessionLocal() as db:
+            # Only replace the provisional title; a rename in the meantime wins.
+            result = await db.execute(
+                update(Chat)
+                .where(Chat.id == chat_id, Chat.title == provisional_title)
+                .values(title=generated_title))
+            if result.rowcount:
+                await bump_history_version(db, user_id)
+            await db.commit()
+    except Exception as e:
+        print(f"Error saving generated title for chat {chat_id}: {e}")
 
 @app.post("/chat")
 async def save_chat(
     payload: ChatMessagePayload,
+    background_tasks: BackgroundTasks,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session)
 ):
     chat_id = payload.chat_id
     message_content = payload.message
 
     if chat_id is None:
-        new_chat_title = await call_llm_for_title_generation(message_content)
+        # The LLM title is produced after the response is sent; clients pick it up
+        # from /history once the background task has bumped the history version.
+        new_chat_title = provisional_chat_title(message_content)
 
         chat = Chat(
-            messages=message_content,
             user_id=user.id,
             title=new_chat_title,
             timestamp=datetime.utcnow()
         )
         db.add(chat)
-        db.commit()
-        db.refresh(chat)
+        await db.flush()
+        await append_messages(db, chat.id, user.id, message_content)
+        await bump_history_version(db, user.id)
+        await db.commit()
 
-        return {"msg": "New chat created and message saved", "chat_id": chat.id, "title": chat.title}
+        background_tasks.add_task(generate_chat_title, chat.id, user.id, new_chat_title, message_content)
+
+        return {"msg": "New chat created and message saved", "chat_id": chat.id, "title": chat.title,
+                "title_pending": True}
     else:
-        chat = db.query(Chat).filter(
+        chat = await db.scalar(select(Chat).where(
             Chat.id == chat_id,
             Chat.user_id == user.id
-        ).first()
+        ))
 
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
 
-        chat.messages = f"{chat.messages}\n{message_content}"
+        await append_messages(db, chat.id, user.id, message_content)
         chat.timestamp = datetime.utcnow()
+        await bump_history_version(db, user.id)
 
-        db.commit()
-        db.refresh(chat)
+        await db.commit()
 
         return {"msg": "Message appended to chat", "chat_id": chat.id, "title": chat.title}
 
-@app.get("/history", response_model=List[dict])
-def get_history(user=Depends(get_current_user), db: Session = Depends(get_db_session)):
-    chats = db.query(Chat).filter(Chat.user_id == user.id).all()
-    return [{"id": c.id, "title": c.title, "messages": c.messages, "timestamp": c.timestamp.isoformat()} for c in chats]
+HISTORY_PAGE_SIZE = 15
+HISTORY_MAX_PAGE_SIZE = 100
+HISTORY_PREVIEW_CHARS = 120
 
-@app.delete("/history/{chat_id}")
-def delete_chat(chat_id: int, user=Depends(get_current_user), db: Session = Depends(get_db_session)):
-    chat = db.query(Chat).filter(Chat.id == chat_id,
-                                 Chat.user_id == user.id).first()
+def encode_history_cursor(timestamp: datetime, chat_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{chat_id}".encode()).decode()
+
+def decode_history_cursor(cursor: str):
+    try:
+        timestamp, chat_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(chat_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/history")
+async def get_history(
+    response: Response,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    # Every chat mutation bumps the version, so an unchanged version means an unchanged listing
+    # and the client can keep what it has without us touching the chats table.
+    history_version = await db.scalar(select(User.history_version).where(User.id == user.id))
+    # Each page (size and cursor) gets its own validator, or revalidating one page could confirm another
+    page_key = hashlib.sha256(f"{limit}:{cursor or ''}".encode()).hexdigest()[:16]
+    etag = f'W/"{user.id}-{history_version}-{page_key}"'
+    # The bare version lets a client tell whether a later page was served from the same listing
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "X-History-Version": str(history_version)}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    first_message = (
+        select(func.substr(ChatMessage.content, 1, HISTORY_PREVIEW_CHARS))
+        .where(ChatMessage.chat_id == Chat.id)
+        .order_by(ChatMessage.seq)
+        .limit(1)
+        .correlate(Chat)
+        .scalar_subquery()
+    )
+    # Chats not yet moved over by migrate_db.py still carry their legacy blob, which holds their first turns
+    preview = func.coalesce(func.substr(func.nullif(Chat.messages, ""), 1, HISTORY_PREVIEW_CHARS), first_message)
+
+    query = select(Chat.id, Chat.title, Chat.timestamp, preview.label("preview")).where(Chat.user_id == user.id)
+    if cursor:
+        cursor_timestamp, cursor_id = decode_history_cursor(cursor)
+        query = query.where(tuple_(Chat.timestamp, Chat.id) < tuple_(cursor_timestamp, cursor_id))
+
+    # One extra row tells us whether another page exists without a COUNT(*)
+    rows = (await db.execute(query.order_by(Chat.timestamp.desc(), Chat.id.desc()).limit(limit + 1))).all()
+    page = rows[:limit]
+    next_cursor = encode_history_cursor(page[-1].timestamp, page[-1].id) if len(rows) > limit else None
+
+    return {
+        "items": [{"id": r.id, "title": r.title, "timestamp": r.timestamp.isoformat(), "preview": r.preview or ""}
+                  for r in page],
+        "next_cursor": next_cursor
+    }
+
+# Declared before /history/{chat_id} so "search" is not taken for a chat id
+@app.get("/history/search")
+async def search_history(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(10, ge=1, le=50),
+    offset: int = Query(0, ge=0, le=1000),
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    return await search_chats(db, user.id, q, limit, offset)
+
+@app.get("/history/{chat_id}")
+async def get_chat(chat_id: int, user=Depends(get_current_user), db: AsyncSession = Depends(get_db_session)):
+    chat = await db.scalar(select(Chat).where(Chat.id == chat_id,
+                                              Chat.user_id == user.id))
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    db.delete(chat)
-    db.commit()
+
+    chat_messages = (await db.scalars(select(ChatMessage).where(ChatMessage.chat_id == chat.id)
+                                      .order_by(ChatMessage.seq))).all()
+    # A blob next to rows means turns were appended before the blob was migrated; it holds the older ones
+    messages = split_messages(chat.messages) + [{"role": m.role, "content": m.content} for m in chat_messages]
+
+    return {"id": chat.id, "title": chat.title, "timestamp": chat.timestamp.isoformat(), "messages": messages}
+
+@app.delete("/history/{chat_id}")
+async def delete_chat(chat_id: int, user=Depends(get_current_user), db: AsyncSession = Depends(get_db_session)):
+    chat_id = await db.scalar(select(Chat.id).where(Chat.id == chat_id,
+                                                    Chat.user_id == user.id))
+    if not chat_id:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    # Bulk statements instead of db.delete(): the ORM would lazy-load relationships,
+    # which AsyncSession cannot do. Uploaded files are detached like the ORM used to do.
+    await db.execute(update(UploadedFile).where(UploadedFile.chat_id == chat_id).values(chat_id=None))
+    await db.execute(delete(ChatMessage).where(ChatMessage.chat_id == chat_id))
+    await db.execute(delete(Chat).where(Chat.id == chat_id))
+    await bump_history_version(db, user.id)
+    await db.commit()
     return {"msg": "Chat deleted"}
 
 @app.put("/history/{chat_id}/rename")
-def rename_chat(chat_id: int, new_title: str, user=Depends(get_current_user), db: Session = Depends(get_db_session)):
-    chat = db.query(Chat).filter(Chat.id == chat_id,
-                                 Chat.user_id == user.id).first()
+async def rename_chat(chat_id: int, new_title: str, user=Depends(get_current_user), db: AsyncSession = Depends(get_db_session)):
+    chat = await db.scalar(select(Chat).where(Chat.id == chat_id,
+                                              Chat.user_id == user.id))
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     chat.title = new_title
-    db.commit()
-    db.refresh(chat)
+    await bump_history_version(db, user.id)
+    await db.commit()
     return {"msg": "Chat renamed", "new_title": chat.title}
 
 class Message(BaseModel):
@@ -210,40 +411,207 @@ class RequestState(BaseModel):
     system_prompt: str
     messages: List[Message]
     allow_search: bool
+    fusion_quorum: Optional[int] = None
+    fusion_timeout: Optional[float] = None
+    bypass_cache: bool = False
+    chat_id: Optional[int] = None
+    # Seconds the whole request may take; defaults to REQUEST_DEADLINE_SECONDS
+    deadline_seconds: Optional[float] = None
 
 ALLOWED_MODEL_NAMES = ['llama3-70b-8192', 'llama-3.3-70b-versatile',
                        "gemini-2.0-flash", "mistralai/Mixtral-8x7B-Instruct-v0.1"]
 
+async def fit_request_context(request: RequestState, user, db: AsyncSession):
+    """Fit the request's history to the target model's token budget; returns (system_prompt, messages).
+
+    Excerpts of the chat's documents relevant to the latest question go into the system prompt,
+    which leaves correspondingly less of the budget for history. Returns with no transaction open
+    on `db`, so the LLM calls that follow don't hold a pooled connection.
+    """
+    system_prompt = request.system_prompt
+    if request.chat_id is not None:
+        owned = await db.scalar(select(Chat.id).where(Chat.id == request.chat_id, Chat.user_id == user.id))
+        if owned is None:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        if request.messages and request.messages[-1].role == "user":
+            excerpts = await retrieve(db, request.chat_id, request.messages[-1].content)
+            if excerpts:
+                system_prompt = f"{system_prompt}\n\n{format_excerpts(excerpts)}"
+    # build_context opens its own short transactions around the summarizer call
+    await db.commit()
+    if request.model_provider == "White-Fusion":
+        budget = FUSION_CONTEXT_BUDGET
+    else:
+        budget = context_budget(request.model_name)
+    return await build_context(db, request.chat_id, request.messages, system_prompt,
+                               budget, summarize_turns)
+
+async def admit_chat_request(request: RequestState, user):
+    """Charge the user's rate limit for this request and take one of their concurrency slots."""
+    try:
+        return await rate_limiter.admit(user.id, request_weight(request.model_provider))
+    except RateLimited as e:
+        detail = "Rate limit exceeded" if e.reason == "rate" else "Too many requests in progress"
+        raise HTTPException(status_code=429, detail=f"{detail}, please retry later.",
+                            headers={"Retry-After": e.retry_after_header})
+
 @app.post('/chat-ai')
-def chat_endpoint(request: RequestState):
+async def chat_endpoint(request: RequestState, user=Depends(get_current_user),
+                        db: AsyncSession = Depends(get_db_session)):
+    if request.model_provider != "White-Fusion" and request.model_name not in ALLOWED_MODEL_NAMES:
+        return {'error': 'Model not supported'}
+
+    # Ends the transaction the user lookup may have begun; the admission queue can take a while
+    await db.commit()
+    with deadline_scope(Deadline.for_request(request.deadline_seconds)):
+        async with await admit_chat_request(request, user):
+            return await answer_chat_request(request, user, db)
+
+async def answer_chat_request(request: RequestState, user, db: AsyncSession):
     try:
         allow_search = request.allow_search
-        system_prompt = request.system_prompt
+        system_prompt, messages = await fit_request_context(request, user, db)
 
         if request.model_provider == "White-Fusion":
-            response = get_head_model_response(
-                request.messages, allow_search, system_prompt)
+            response = await get_head_model_response(
+                messages, allow_search, system_prompt,
+                quorum=request.fusion_quorum, provider_timeout=request.fusion_timeout,
+                use_cache=not request.bypass_cache)
         else:
-            if request.model_name not in ALLOWED_MODEL_NAMES:
-                return {'error': 'Model not supported'}
-
             llm_id = request.model_name
             provider = request.model_provider
-            response = get_respoonse(
-                llm_id, request.messages, allow_search, system_prompt, provider)
+            response = await get_respoonse(
+                llm_id, messages, allow_search, system_prompt, provider,
+                use_cache=not request.bypass_cache)
 
         return response
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
+@app.get('/stats')
+async def stats():
+    return {"llm_cache": response_cache.stats(), "similarity_cache": similarity_cache.stats(),
+            "llm_clients": llm_registry.stats(), "password_hasher": password_hasher.stats(),
+            "mail_queue": mail_queue.stats(), "rate_limit": rate_limiter.stats(),
+            "scheduler": scheduler.stats(), "providers": provider_health.stats()}
+
+def labelled(read):
+    """Adapt a {label value: number} reader to the (label values, number) pairs a callback metric returns."""
+    return lambda: [((key,), value) for key, value in read().items()]
+
+def default_thread_limiter():
+    # Sync endpoints and run_in_threadpool share this anyio limiter; only readable on the event loop
+    return anyio.to_thread.current_default_thread_limiter()
+
+# Everything below is read at scrape time from counters the components keep anyway, so it
+# costs nothing between scrapes.
+metrics.callback("llm_cache_events_total", "Exact-match LLM response cache lookups and stores",
+                 labelled(lambda: response_cache.counters), "counter", ("event",))
+metrics.callback("llm_cache_hit_ratio", "Share of LLM response cache lookups that hit",
+                 lambda: response_cache.stats()["hit_ratio"])
+metrics.callback("similarity_cache_events_total", "Near-duplicate prompt cache lookups, stores and evictions",
+                 labelled(lambda: similarity_cache.counters), "counter", ("event",))
+metrics.callback("similarity_cache_hit_ratio", "Share of similarity cache lookups that hit",
+                 lambda: similarity_cache.stats()["hit_ratio"])
+metrics.callback("cache_entries", "Entries held in this worker's caches",
+                 labelled(lambda: {"llm": response_cache.stats()["entries"],
+                                   "similarity": similarity_cache.stats()["entries"],
+                                   "llm_clients": llm_registry.stats()["clients"]}), labelnames=("cache",))
+metrics.callback("rate_limit_events_total", "Chat requests admitted, queued or rejected by the per-user limiter",
+                 labelled(lambda: rate_limiter.counters), "counter", ("event",))
+metrics.callback("rate_limit_waiting", "Chat requests queued behind their user's concurrency cap",
+                 lambda: rate_limiter.stats()["waiting"])
+metrics.callback("provider_in_flight", "Provider calls holding a scheduler slot",
+                 labelled(lambda: {provider: queue.in_flight for provider, queue in scheduler.queues.items()}),
+                 labelnames=("provider",))
+metrics.callback("provider_waiting", "Provider calls waiting for a scheduler slot",
+                 labelled(lambda: {provider: len(queue.waiters) for provider, queue in scheduler.queues.items()}),
+                 labelnames=("provider",))
+metrics.callback("provider_circuit_open", "1 while a provider's circuit breaker is not closed",
+                 labelled(lambda: {provider: int(breaker.state != "closed")
+                                   for provider, breaker in provider_health.breakers.items()}),
+                 labelnames=("provider",))
+metrics.callback("provider_hedge_events_total", "Hedged and failed-over provider calls",
+                 labelled(lambda: provider_health.counters), "counter", ("event",))
+metrics.callback("password_hash_in_flight", "bcrypt hashes and checks running or queued",
+                 lambda: password_hasher.in_flight)
+metrics.callback("mail_queue_depth", "OTP mails waiting to be sent", lambda: mail_queue.queue.qsize())
+metrics.callback("mail_events_total", "OTP mails and SMTP connections",
+                 labelled(lambda: mail_queue.counters), "counter", ("event",))
+metrics.callback("db_pool_connections", "Async database pool connections by state",
+                 labelled(lambda: {"checked_out": async_engine.pool.checkedout(),
+                                   "idle": async_engine.pool.checkedin(),
+                                   "overflow": max(async_engine.pool.overflow(), 0)}), labelnames=("state",))
+metrics.callback("threadpool_busy", "Threads of the default threadpool in use",
+                 lambda: default_thread_limiter().borrowed_tokens)
+metrics.callback("threadpool_size", "Threads the default threadpool may use",
+                 lambda: default_thread_limiter().total_tokens)
+
+@app.get('/metrics')
+async def metrics_endpoint():
+    # Rendered on the event loop, which the threadpool gauges need
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+def sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
+@app.post('/chat-ai/stream')
+async def chat_stream_endpoint(request: RequestState, user=Depends(get_current_user),
+                               db: AsyncSession = Depends(get_db_session)):
+    if request.model_provider != "White-Fusion" and request.model_name not in ALLOWED_MODEL_NAMES:
+        return {'error': 'Model not supported'}
+    deadline = Deadline.for_request(request.deadline_seconds)
+    await db.commit()
+    with deadline_scope(deadline):
+        admission = await admit_chat_request(request, user)
+        try:
+            # Built before streaming starts: the DB session is released once the response is returned
+            system_prompt, messages = await fit_request_context(request, user, db)
+        except BaseException:
+            admission.release()
+            raise
+
+    async def event_stream():
+        # Runs in the task that sends the response, whose context ends with it; no reset needed
+        current_deadline.set(deadline)
+        try:
+            timings = {}
+            if request.model_provider == "White-Fusion":
+                chunks = stream_head_model_response(
+                    messages, request.allow_search, system_prompt,
+                    quorum=request.fusion_quorum, provider_timeout=request.fusion_timeout, timings=timings,
+                    use_cache=not request.bypass_cache)
+            else:
+                chunks = stream_respoonse(
+                    request.model_name, messages, request.allow_search,
+                    system_prompt, request.model_provider, use_cache=not request.bypass_cache)
+
+            async for chunk in chunks:
+                yield sse_event({"type": "token", "content": chunk})
+            if timings:
+                yield sse_event({"type": "timings", "timings": timings})
+        except Exception as e:
+            print(f"Error in chat stream ({request.model_provider}, {request.model_name}): {e}")
+            yield sse_event({"type": "error", "error": str(e)})
+        finally:
+            admission.release()
+        yield sse_event({"type": "done"})
+
+    # The background task covers a client that goes away before the stream starts; release is idempotent
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background=BackgroundTask(admission.release))
+
 @app.post("/verify-otp")
-def verify_otp(data: schemas.VerifyOTP, db: Session = Depends(get_db_session)):
-    otp_entry = (
-        db.query(models.OTP)
-        .filter(models.OTP.email == data.email)
+async def verify_otp(data: schemas.VerifyOTP, db: AsyncSession = Depends(get_db_session)):
+    otp_entry = await db.scalar(
+        select(models.OTP)
+        .where(models.OTP.email == data.email)
         .order_by(models.OTP.expires_at.desc())
-        .first()
+        .limit(1)
     )
 
     if not otp_entry:
@@ -253,7 +621,7 @@ def verify_otp(data: schemas.VerifyOTP, db: Session = Depends(get_db_session)):
     if otp_entry.otp != data.otp:
         raise HTTPException(status_code=400, detail="Invalid OTP.")
 
-    existing_user = db.query(models.User).filter(models.User.username == data.email).first()
+    existing_user = await db.scalar(select(models.User).where(models.User.username == data.email))
     if existing_user:
         return {"message": "User already verified."}
 
@@ -263,130 +631,144 @@ def verify_otp(data: schemas.VerifyOTP, db: Session = Depends(get_db_session)):
         password=otp_entry.password
     )
     db.add(new_user)
-    db.commit()
+    await db.commit()
+    # The username may have belonged to an earlier account still held in the identity cache
+    invalidate_user(new_user.username)
 
-    db.delete(otp_entry)
-    db.commit()
+    await db.delete(otp_entry)
+    await db.commit()
 
     return {"message": "Email successfully verified and user created!"}
 
 @app.post("/resend-otp")
-def resend_otp(email: str = Body(..., embed=True), db: Session = Depends(get_db_session)):
-    user_check = db.query(models.User).filter(models.User.email == email).first()
+async def resend_otp(email: str = Body(..., embed=True), db: AsyncSession = Depends(get_db_session)):
+    user_check = await db.scalar(select(models.User).where(models.User.email == email))
     if user_check:
         raise HTTPException(status_code=400, detail="User already registered and verified. Please login.")
 
-    existing_otp_entry = db.query(models.OTP).filter(models.OTP.email == email).first()
+    existing_otp_entry = await db.scalar(select(models.OTP).where(models.OTP.email == email).limit(1))
     if existing_otp_entry and existing_otp_entry.expires_at > datetime.utcnow() - timedelta(seconds=30):
         raise HTTPException(status_code=400, detail="Please wait before resending OTP.")
     
-    otp = auth.generate_otp(email)
-    auth.send_mail(email, otp)
-
-    if existing_otp_entry:
-        existing_otp_entry.otp = otp
-        existing_otp_entry.expires_at = datetime.utcnow() + timedelta(minutes=5)
-    else:
+    if not existing_otp_entry:
         raise HTTPException(status_code=400, detail="No pending signup found for this email. Please sign up first.")
-        
-    db.commit()
+
+    otp = auth.generate_otp(email)
+    existing_otp_entry.otp = otp
+    existing_otp_entry.expires_at = datetime.utcnow() + timedelta(minutes=5)
+    await db.commit()
+    queue_otp_mail(email, otp)
     return {"message": "New OTP sent to your email."}
 
-@app.post("/upload-pdf-to-chat/")
+async def enqueue_ingestion(db: AsyncSession, user_id: int, file_name: str, file_type: str, payload: bytes,
+                            chat_id: Optional[int] = None):
+    if chat_id is not None:
+        owned = await db.scalar(select(Chat.id).where(Chat.id == chat_id, Chat.user_id == user_id))
+        if owned is None:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+    content_hash = (await asyncio.to_thread(hashlib.sha256, payload)).hexdigest()
+
+    # Same bytes seen before: reuse the stored extraction and finish the job right away.
+    cached_text = await db.scalar(select(ExtractionCache.extracted_text).where(
+        ExtractionCache.kind == file_type, ExtractionCache.content_hash == content_hash))
+    if cached_text is not None:
+        if chat_id is not None:
+            uploaded_file = await asyncio.to_thread(
+                new_uploaded_file, user_id, file_name, file_type, cached_text, chat_id)
+            db.add(uploaded_file)
+            await db.flush()
+            file_id = uploaded_file.id
+        else:
+            chat = await asyncio.to_thread(new_upload_chat, user_id, file_name, file_type, cached_text)
+            db.add(chat)
+            await db.flush()
+            chat_id, file_id = chat.id, chat.uploaded_files[0].id
+            await bump_history_version(db, user_id)
+        pages_total = len(cached_text["pages"]) if file_type == "pdf" else 1
+        job = IngestionJob(
+            user_id=user_id,
+            file_name=file_name,
+            file_type=file_type,
+            content_hash=content_hash,
+            status="done",
+            pages_done=pages_total,
+            pages_total=pages_total,
+            chat_id=chat_id,
+            file_id=file_id,
+            created_at=datetime.utcnow(),
+            updated_at=datetime.utcnow(),
+            finished_at=datetime.utcnow()
+        )
+        db.add(job)
+        await db.commit()
+        return {"msg": "File processed from cache", "job_id": job.id, "status": job.status,
+                "chat_id": job.chat_id, "file_id": job.file_id, "extracted_text": cached_text}
+
+    job = IngestionJob(
+        user_id=user_id,
+        file_name=file_name,
+        file_type=file_type,
+        payload=payload,
+        content_hash=content_hash,
+        chat_id=chat_id,
+        status="queued",
+        created_at=datetime.utcnow(),
+        updated_at=datetime.utcnow()
+    )
+    db.add(job)
+    await db.commit()
+    return {"msg": "File queued for processing", "job_id": job.id, "status": job.status}
+
+@app.post("/upload-pdf-to-chat/", status_code=status.HTTP_202_ACCEPTED)
 async def upload_pdf_to_chat(
     file: UploadFile = File(...),
+    chat_id: Optional[int] = Form(None),
     user=Depends(get_current_user),
-    db: Session = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session)
 ):
     if not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400, detail="File is not a PDF.")
 
-    contents = await file.read()
-    doc = fitz.open(stream=contents, filetype="pdf")
-
-    raw_text_pages = []
-
-    for page in doc:
-        text = page.get_text().strip()
+    # Extraction happens in ingest_worker.py; poll /ingest-jobs/{job_id} for the result.
+    # With a chat_id the document is attached to that chat instead of starting a new one.
+    return await enqueue_ingestion(db, user.id, file.filename, "pdf", await file.read(), chat_id)
 
-        if not text:
-            pix = page.get_pixmap()
-            img = Image.open(io.BytesIO(pix.tobytes()))
-            text = pytesseract.image_to_string(img)
-
-        raw_text_pages.append(text)
-
-    json_text = {"pages": raw_text_pages}
-    full_text = "\n".join(raw_text_pages)
-
-    chat = Chat(
-        title=f"PDF: {file.filename[:50]}", # Placeholder title, consider using LLM to summarize PDF content for title
-        messages=full_text,
-        user_id=user.id,
-        timestamp=datetime.utcnow()
-    )
-    db.add(chat)
-    db.commit()
-    db.refresh(chat)
-
-    uploaded_file = UploadedFile(
-        file_name=file.filename,
-        file_type="pdf",
-        extracted_text=json_text,
-        user_id=user.id,
-        chat_id=chat.id,
-        uploaded_at=datetime.utcnow()
-    )
-    db.add(uploaded_file)
-    db.commit()
-
-    return {
-        "msg": "PDF uploaded and stored with chat",
-        "chat_id": chat.id,
-        "file_id": uploaded_file.id,
-        "extracted_text": json_text
-    }
-
-@app.post("/upload-image-to-chat/")
+@app.post("/upload-image-to-chat/", status_code=status.HTTP_202_ACCEPTED)
 async def upload_image_to_chat(
     file: UploadFile = File(...),
+    chat_id: Optional[int] = Form(None),
     user=Depends(get_current_user),
-    db: Session = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session)
 ):
-    try:
-        image = Image.open(io.BytesIO(await file.read()))
-        text = pytesseract.image_to_string(image)
-
-        chat = Chat(
-            title=f"Image: {file.filename[:50]}", # Placeholder title, consider using LLM to summarize image content for title
-            messages=text,
-            user_id=user.id,
-            timestamp=datetime.utcnow()
-        )
-        db.add(chat)
-        db.commit()
-        db.refresh(chat)
-        
-        uploaded_file = UploadedFile(
-            file_name=file.filename,
-            file_type="image",
-            extracted_text=text,
-            user_id=user.id,
-            chat_id=chat.id,
-            uploaded_at=datetime.utcnow()
-        )
-        db.add(uploaded_file)
-        db.commit()
-
-        return {
-            "msg": "Image uploaded and stored with chat",
-            "chat_id": chat.id,
-            "file_id": uploaded_file.id,
-            "extracted_text": text
-        }
-
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    return await enqueue_ingestion(db, user.id, file.filename, "image", await file.read(), chat_id)
+
+@app.get("/ingest-jobs/{job_id}")
+async def get_ingestion_job(job_id: int, user=Depends(get_current_user), db: AsyncSession = Depends(get_db_session)):
+    job = (await db.execute(
+        select(IngestionJob.id, IngestionJob.status, IngestionJob.file_name, IngestionJob.file_type,
+               IngestionJob.pages_done, IngestionJob.pages_total, IngestionJob.error,
+               IngestionJob.chat_id, IngestionJob.file_id)
+        .where(IngestionJob.id == job_id, IngestionJob.user_id == user.id)
+    )).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    result = {
+        "job_id": job.id,
+        "status": job.status,
+        "file_name": job.file_name,
+        "file_type": job.file_type,
+        "pages_done": job.pages_done,
+        "pages_total": job.pages_total,
+        "error": job.error,
+        "chat_id": job.chat_id,
+        "file_id": job.file_id
+    }
+    if job.status == "done" and job.file_id:
+        result["extracted_text"] = await db.scalar(
+            select(UploadedFile.extracted_text).where(UploadedFile.id == job.file_id))
+    return result
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="127.0.0.1", port=8000)
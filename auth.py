@@ -1,24 +1,124 @@
 from datetime import datetime, timedelta
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import time
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import random
-import smtplib
 from email.message import EmailMessage
 from dotenv import load_dotenv
 load_dotenv()
 import os
+from cache import TTLCache
+from mailer import mail_queue, MAIL_FROM
 
 
 
 SECRET_KEY = "Your-Secret-Key-Here"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Tokens carry the user id as "uid"; when trusted, a valid signature is all a request needs
+TRUST_TOKEN_USER_ID = os.environ.get("TRUST_TOKEN_USER_ID", "1") == "1"
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", "300"))
+AUTH_CACHE_MAX_SIZE = int(os.environ.get("AUTH_CACHE_MAX_SIZE", "10000"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+@dataclass(frozen=True)
+class CurrentUser:
+    """The authenticated caller as endpoints see it; a plain value, not a session-bound User row."""
+    id: int
+    username: str
+
+
+# username -> CurrentUser, for tokens without a trusted uid claim
+user_cache = TTLCache(AUTH_CACHE_MAX_SIZE, AUTH_CACHE_TTL)
+
+def invalidate_user(username: str):
+    user_cache.delete(username)
+
+# Cost factor for new hashes. Hashes made at any other cost still verify, and are
+# replaced at the next successful login (min == max makes passlib flag them).
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get("PASSWORD_HASH_QUEUE_LIMIT", "64"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 def get_password_hash(password):
     return pwd_context.hash(password)
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """Runs bcrypt on its own bounded thread pool instead of the event loop or the shared threadpool.
+
+    bcrypt releases the GIL, so the threads use real cores, and a login burst queues here rather
+    than starving other endpoints. Once `queue_limit` calls are waiting, new ones fail fast with
+    PasswordHasherBusy.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, queue_limit: int = PASSWORD_HASH_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        # Only touched from the event loop thread
+        self.in_flight = 0
+        self.counters = {"hashed": 0, "verified": 0, "rehashed": 0, "rejected": 0}
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    async def _run(self, fn, *args):
+        if self.in_flight >= self.workers + self.queue_limit:
+            self.counters["rejected"] += 1
+            raise PasswordHasherBusy()
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            result = fn(*args)
+            return result, started - submitted, time.perf_counter() - started
+
+        self.in_flight += 1
+        try:
+            result, waited, ran = await asyncio.get_running_loop().run_in_executor(self.executor, timed)
+        finally:
+            self.in_flight -= 1
+        self.wait_seconds += waited
+        self.run_seconds += ran
+        return result
+
+    async def hash(self, password: str):
+        hashed = await self._run(pwd_context.hash, password)
+        self.counters["hashed"] += 1
+        return hashed
+
+    async def verify(self, password: str, hashed: str):
+        """Return (valid, new_hash); new_hash is set when the stored hash used another cost."""
+        valid, new_hash = await self._run(pwd_context.verify_and_update, password, hashed)
+        self.counters["verified"] += 1
+        if new_hash:
+            self.counters["rehashed"] += 1
+        return valid, new_hash
+
+    def stats(self):
+        calls = self.counters["hashed"] + self.counters["verified"]
+        return {**self.counters, "rounds": BCRYPT_ROUNDS, "workers": self.workers,
+                "in_flight": self.in_flight, "queued": max(self.in_flight - self.workers, 0),
+                "avg_wait_ms": round(self.wait_seconds / calls * 1000, 1) if calls else 0.0,
+                "avg_run_ms": round(self.run_seconds / calls * 1000, 1) if calls else 0.0}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hasher = PasswordHasher()
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta if expires_delta else timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -29,15 +129,11 @@ def generate_otp(email: str):
     return str(random.randint(100000, 999999))
 
 def send_mail(receiver_email: str, otp:str):
-    sender = os.getenv("EMAIL")
-    password = os.getenv("PASSWORD")
-
+    """Queue the OTP mail; raises MailQueueFull if the sender is too far behind."""
     msg =  EmailMessage()
     msg['Subject'] = 'Your OTP Code'
-    msg['From'] = sender
+    msg['From'] = MAIL_FROM
     msg['To'] = receiver_email
     msg.set_content(f"Your OTP code is: {otp}, It will expire in 5 minutes.")
-    
-    with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
-        smtp.login(sender, password)
-        smtp.send_message(msg)
+
+    mail_queue.send(msg)
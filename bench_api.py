@@ -0,0 +1,78 @@
+# bench_api.py
+# Concurrent-request throughput against a running API, e.g. before/after a change:
+#   python bench_api.py --token <jwt> --path /history --concurrency 50 --requests 2000
+# Add --slow-path /chat-ai to keep that many slow requests in flight at the same time
+# and see whether they hold up the fast endpoint.
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+def timed_request(session, method, url, headers, json_body, form_body):
+    started = time.perf_counter()
+    try:
+        res = session.request(method, url, headers=headers, json=json_body, data=form_body, timeout=120)
+        ok = res.status_code < 500
+    except requests.RequestException:
+        ok = False
+    return ok, time.perf_counter() - started
+
+def run(args):
+    url = f"{args.url.rstrip('/')}{args.path}"
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    form_body = dict(pair.split("=", 1) for pair in args.form) if args.form else None
+    local = threading.local()
+
+    def worker(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return timed_request(local.session, args.method, url, headers, None, form_body)
+
+    stop_background = threading.Event()
+    background = []
+    if args.slow_path:
+        slow_url = f"{args.url.rstrip('/')}{args.slow_path}"
+        slow_body = {"model_name": "llama-3.3-70b-versatile", "model_provider": "Groq",
+                     "system_prompt": "", "allow_search": False,
+                     "messages": [{"role": "user", "content": "Write a long story about a lighthouse."}]}
+
+        def slow_worker():
+            session = requests.Session()
+            while not stop_background.is_set():
+                timed_request(session, "POST", slow_url, headers, slow_body, None)
+
+        background = [threading.Thread(target=slow_worker, daemon=True) for _ in range(args.slow_concurrency)]
+        for thread in background:
+            thread.start()
+        time.sleep(1)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(worker, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    stop_background.set()
+
+    latencies = sorted(latency for _, latency in results)
+    failures = sum(1 for ok, _ in results if not ok)
+    print(f"{args.method} {url}")
+    print(f"requests={args.requests} concurrency={args.concurrency} failures={failures}")
+    print(f"throughput={args.requests / elapsed:.1f} req/s  wall={elapsed:.2f}s")
+    print(f"p50={statistics.median(latencies) * 1000:.1f}ms  "
+          f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms  "
+          f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent throughput benchmark for the API")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--path", default="/history")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--token", default="")
+    parser.add_argument("--form", nargs="*", help="form fields as key=value, e.g. username=a password=b")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--slow-path", default="")
+    parser.add_argument("--slow-concurrency", type=int, default=40)
+    run(parser.parse_args())
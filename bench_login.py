@@ -0,0 +1,104 @@
+# bench_login.py
+# Login throughput against a running API, and what a login burst does to other requests:
+#   python bench_login.py --username a@example.com --password secret --concurrency 32 --requests 500
+#   python bench_login.py --probe-token <jwt> --probe-path /history ...
+# --rounds 10 11 12 13 only times bcrypt locally at those costs, to pick BCRYPT_ROUNDS.
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from passlib.context import CryptContext
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return (f"p50={statistics.median(latencies) * 1000:.1f}ms  "
+            f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms  "
+            f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms")
+
+def time_rounds(rounds_list, samples):
+    for rounds in rounds_list:
+        context = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=rounds)
+        hashed = context.hash("benchmark-password")
+        durations = []
+        for _ in range(samples):
+            started = time.perf_counter()
+            context.verify("benchmark-password", hashed)
+            durations.append(time.perf_counter() - started)
+        print(f"rounds={rounds}: verify {statistics.median(durations) * 1000:.0f}ms per login on one core")
+
+def run(args):
+    base = args.url.rstrip("/")
+    local = threading.local()
+    statuses = {}
+    status_lock = threading.Lock()
+
+    def login(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            res = local.session.post(f"{base}/login", timeout=120,
+                                     data={"username": args.username, "password": args.password})
+            status = res.status_code
+        except requests.RequestException:
+            status = "error"
+        with status_lock:
+            statuses[status] = statuses.get(status, 0) + 1
+        return time.perf_counter() - started
+
+    # A single client polling a cheap endpoint for the whole burst
+    stop_probe = threading.Event()
+    probe_latencies = []
+
+    def probe():
+        session = requests.Session()
+        headers = {"Authorization": f"Bearer {args.probe_token}"} if args.probe_token else {}
+        while not stop_probe.is_set():
+            started = time.perf_counter()
+            try:
+                session.get(f"{base}{args.probe_path}", headers=headers, timeout=30)
+            except requests.RequestException:
+                pass
+            probe_latencies.append(time.perf_counter() - started)
+            time.sleep(0.05)
+
+    probe_thread = threading.Thread(target=probe, daemon=True)
+    probe_thread.start()
+    time.sleep(1)
+    idle_probes = len(probe_latencies)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = list(pool.map(login, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    stop_probe.set()
+    probe_thread.join()
+
+    print(f"POST {base}/login  requests={args.requests} concurrency={args.concurrency}")
+    print(f"status codes: {dict(sorted(statuses.items(), key=str))}")
+    print(f"throughput={args.requests / elapsed:.1f} logins/s  wall={elapsed:.2f}s")
+    print(f"login    {percentiles(latencies)}")
+    if idle_probes:
+        print(f"probe idle  {percentiles(probe_latencies[:idle_probes])}")
+    if len(probe_latencies) > idle_probes:
+        print(f"probe burst {percentiles(probe_latencies[idle_probes:])}  ({args.probe_path})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Login throughput benchmark")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--username", default="")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--probe-path", default="/stats")
+    parser.add_argument("--probe-token", default="")
+    parser.add_argument("--rounds", type=int, nargs="*", help="only time bcrypt locally at these costs")
+    parser.add_argument("--samples", type=int, default=5)
+    args = parser.parse_args()
+    if args.rounds:
+        time_rounds(args.rounds, args.samples)
+    else:
+        run(args)
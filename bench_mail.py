@@ -0,0 +1,123 @@
+# bench_mail.py
+# OTP mail delivery against a local stand-in SMTP server started in-process, so it needs no
+# mail account:
+#   python bench_mail.py --messages 200 --connect-delay 0.3 --drop-every 50
+# --connect-delay stands in for the TLS handshake and login a real server costs per connection;
+# --drop-every makes the server hang up on a connection after that many messages, the way
+# providers close long-lived sessions, to exercise reconnects.
+import argparse
+import os
+import smtplib
+import socketserver
+import statistics
+import threading
+import time
+from email.message import EmailMessage
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        time.sleep(server.connect_delay)
+        self.reply("220 stand-in ready")
+        delivered = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 stand-in")
+            elif command.startswith("DATA"):
+                self.reply("354 go ahead")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                with server.lock:
+                    server.delivered += 1
+                delivered += 1
+                self.reply("250 queued")
+                if server.drop_every and delivered % server.drop_every == 0:
+                    return
+            elif command.startswith("QUIT"):
+                self.reply("221 bye")
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP
+                self.reply("250 ok")
+
+class StandInSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_delay, drop_every):
+        super().__init__(("127.0.0.1", 0), StandInSMTPHandler)
+        self.connect_delay = connect_delay
+        self.drop_every = drop_every
+        self.delivered = 0
+        self.lock = threading.Lock()
+
+def make_message(i):
+    msg = EmailMessage()
+    msg['Subject'] = 'Your OTP Code'
+    msg['From'] = "bench@example.com"
+    msg['To'] = f"user{i}@example.com"
+    msg.set_content(f"Your OTP code is: {100000 + i}, It will expire in 5 minutes.")
+    return msg
+
+def wait_for(server, count, timeout=120):
+    deadline = time.monotonic() + timeout
+    while server.delivered < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+def main(args):
+    server = StandInSMTPServer(args.connect_delay, args.drop_every)
+    host, port = server.server_address
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.update({"SMTP_HOST": host, "SMTP_PORT": str(port), "SMTP_USE_SSL": "0", "SMTP_USERNAME": "",
+                       "MAIL_FROM": "bench@example.com", "MAIL_SENDERS": str(args.senders)})
+    from mailer import MailQueue
+
+    # Before: a fresh connection per OTP, inside the request
+    count = min(args.messages, args.direct_messages)
+    latencies = []
+    started = time.perf_counter()
+    for i in range(count):
+        sent = time.perf_counter()
+        with smtplib.SMTP(host, port) as smtp:
+            smtp.send_message(make_message(i))
+        latencies.append(time.perf_counter() - sent)
+    elapsed = time.perf_counter() - started
+    print(f"connection per message: {count} mails in {elapsed:.2f}s ({count / elapsed:.1f}/s), "
+          f"request blocked p50={statistics.median(latencies) * 1000:.1f}ms")
+
+    # After: enqueue and return; senders reuse their connections
+    server.delivered = 0
+    mail_queue = MailQueue(senders=args.senders)
+    mail_queue.start()
+    time.sleep(0.1)
+    latencies = []
+    started = time.perf_counter()
+    for i in range(args.messages):
+        sent = time.perf_counter()
+        mail_queue.send(make_message(i))
+        latencies.append(time.perf_counter() - sent)
+    wait_for(server, args.messages)
+    elapsed = time.perf_counter() - started
+    mail_queue.stop()
+    latencies.sort()
+    print(f"mail queue ({args.senders} senders): {server.delivered}/{args.messages} mails in {elapsed:.2f}s "
+          f"({server.delivered / elapsed:.1f}/s), request blocked p50={statistics.median(latencies) * 1e6:.0f}us "
+          f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1e6:.0f}us")
+    print(f"queue stats: {mail_queue.stats()}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OTP mail delivery benchmark against a stand-in SMTP server")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--direct-messages", type=int, default=30, help="cap for the slow per-connection run")
+    parser.add_argument("--senders", type=int, default=2)
+    parser.add_argument("--connect-delay", type=float, default=0.3)
+    parser.add_argument("--drop-every", type=int, default=50)
+    main(parser.parse_args())
@@ -0,0 +1,58 @@
+# bench_ocr.py
+# Serial vs process-pool OCR on a synthetic scanned PDF (image-only pages, no text layer):
+#   python bench_ocr.py --pages 40
+import argparse
+import io
+import os
+import time
+
+import fitz
+from PIL import Image, ImageDraw
+
+import ocr
+
+def make_scanned_pdf(page_count: int) -> bytes:
+    doc = fitz.open()
+    for page_number in range(page_count):
+        img = Image.new("L", (1240, 1754), 255)
+        draw = ImageDraw.Draw(img)
+        for line in range(40):
+            draw.text((80, 80 + line * 40),
+                      f"Page {page_number + 1} line {line + 1}: the quick brown fox jumps over the lazy dog",
+                      fill=0)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        page = doc.new_page(width=595, height=842)
+        page.insert_image(page.rect, stream=buf.getvalue())
+    return doc.tobytes()
+
+def serial_extract(pdf_bytes: bytes):
+    pages = ocr._text_layer(pdf_bytes)
+    missing = [n for n, text in enumerate(pages) if not text]
+    for page_number, text, _ in ocr._ocr_pages(pdf_bytes, missing):
+        pages[page_number] = text
+    return pages
+
+def main(args):
+    pdf_bytes = make_scanned_pdf(args.pages)
+    print(f"{args.pages} scanned pages, {len(pdf_bytes) / 1e6:.1f} MB, {ocr.OCR_WORKERS} OCR workers")
+
+    started = time.perf_counter()
+    serial_pages = serial_extract(pdf_bytes)
+    serial = time.perf_counter() - started
+    print(f"serial:   {serial:.2f}s  ({serial / args.pages * 1000:.0f} ms/page)")
+
+    # Start the pool outside the timed region, as the API does on its first upload
+    ocr.get_ocr_executor().submit(os.getpid).result()
+    started = time.perf_counter()
+    parallel_pages = ocr.extract_pdf_pages(pdf_bytes)
+    parallel = time.perf_counter() - started
+    print(f"parallel: {parallel:.2f}s  ({parallel / args.pages * 1000:.0f} ms/page)")
+
+    print(f"speedup:  {serial / parallel:.2f}x  (page order preserved: {parallel_pages == serial_pages})")
+    ocr.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OCR pipeline benchmark")
+    parser.add_argument("--pages", type=int, default=40)
+    main(parser.parse_args())
@@ -0,0 +1,80 @@
+# bench_retrieval.py
+# Chunking, index build and query cost of the BM25 retrieval index on a synthetic corpus:
+#   python bench_retrieval.py --pages 1000
+# Queries are phrases lifted from random pages, so recall@k shows whether the source page
+# makes it into the excerpts.
+import argparse
+import random
+import statistics
+import time
+import tracemalloc
+
+from context import estimate_tokens
+from retrieval import BM25Index, Chunk, chunk_document, RETRIEVAL_TOP_K, RETRIEVAL_TOKENS
+
+def make_vocabulary(rng, size):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+def make_pages(rng, page_count, vocabulary, words_per_page):
+    # Zipf-like word frequencies, as in real text: a few very common terms and a long tail
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    return [" ".join(rng.choices(vocabulary, weights, k=words_per_page)) for _ in range(page_count)]
+
+def main(args):
+    rng = random.Random(11)
+    vocabulary = make_vocabulary(rng, args.vocabulary)
+    pages = make_pages(rng, args.pages, vocabulary, args.words_per_page)
+    document_tokens = sum(estimate_tokens(page) for page in pages)
+
+    started = time.perf_counter()
+    chunks = [Chunk(seq, "corpus.pdf", page, content)
+              for seq, (page, content) in enumerate(chunk_document("pdf", {"pages": pages}), start=1)]
+    chunking = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index = BM25Index(chunks)
+    build = time.perf_counter() - started
+
+    # Built a second time for the size: tracing slows the build down several times
+    tracemalloc.start()
+    traced_index = BM25Index(chunks)
+    index_mb = tracemalloc.get_traced_memory()[0] / 1e6
+    tracemalloc.stop()
+    del traced_index
+
+    print(f"{args.pages} pages, {len(chunks)} chunks, {len(index.postings)} terms, ~{document_tokens} tokens")
+    print(f"chunking: {chunking * 1000:.0f} ms   index build: {build * 1000:.0f} ms   index size: {index_mb:.1f} MB")
+
+    latencies, found, prompt_tokens = [], 0, []
+    for _ in range(args.queries):
+        page_number = rng.randrange(args.pages)
+        words = pages[page_number].split()
+        offset = rng.randrange(len(words) - 8)
+        query = " ".join(words[offset:offset + rng.randint(3, 8)])
+
+        started = time.perf_counter()
+        hits = index.search(query, RETRIEVAL_TOP_K)
+        latencies.append(time.perf_counter() - started)
+
+        found += any(chunk.page == page_number + 1 for chunk, _ in hits)
+        tokens = 0
+        for chunk, _ in hits:
+            if tokens + estimate_tokens(chunk.content) <= RETRIEVAL_TOKENS:
+                tokens += estimate_tokens(chunk.content)
+        prompt_tokens.append(tokens)
+
+    latencies.sort()
+    print(f"query: p50={statistics.median(latencies) * 1000:.2f}ms  "
+          f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f}ms  "
+          f"recall@{RETRIEVAL_TOP_K}={found / args.queries:.2%}")
+    print(f"prompt tokens per turn: whole document ~{document_tokens}, "
+          f"excerpts ~{statistics.mean(prompt_tokens):.0f} (budget {RETRIEVAL_TOKENS})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrieval index benchmark")
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--words-per-page", type=int, default=450)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=500)
+    main(parser.parse_args())
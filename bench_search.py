@@ -0,0 +1,125 @@
+# bench_search.py
+# Latency of /history/search's query at scale, against the database configured in database.py:
+#   python bench_search.py --seed --users 1000 --chats-per-user 50 --messages-per-chat 40
+#   python bench_search.py --queries 500
+#   python bench_search.py --cleanup
+# Seeding writes synthetic users named bench-search-*; the text is generated server side
+# from a skewed vocabulary, so some query terms match a large share of a user's messages.
+import argparse
+import asyncio
+import hashlib
+import random
+import statistics
+import time
+
+from sqlalchemy import text
+
+from database import engine, AsyncSessionLocal
+from search import search_chats
+
+USER_PREFIX = "bench-search-"
+
+def vocabulary_word(i: int):
+    # Same words as the SQL generator below
+    return hashlib.md5(str(i).encode()).hexdigest()[:4 + i % 6]
+
+def seed(args):
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO users (username, email, password, history_version)
+            SELECT :prefix || g, :prefix || g || '@example.com', 'x', 0 FROM generate_series(1, :users) g
+            ON CONFLICT DO NOTHING"""), {"prefix": USER_PREFIX, "users": args.users})
+        conn.execute(text("""
+            INSERT INTO chats (title, user_id, timestamp)
+            SELECT 'Bench chat ' || s, u.id, now() - s * interval '1 hour'
+            FROM users u CROSS JOIN generate_series(1, :chats) s
+            WHERE u.username LIKE :pattern"""), {"chats": args.chats_per_user, "pattern": USER_PREFIX + "%"})
+        user_ids = [row[0] for row in conn.execute(
+            text("SELECT id FROM users WHERE username LIKE :pattern ORDER BY id"), {"pattern": USER_PREFIX + "%"})]
+
+    started = time.perf_counter()
+    for batch_start in range(0, len(user_ids), 50):
+        batch = user_ids[batch_start:batch_start + 50]
+        with engine.begin() as conn:
+            # The inner series references s.seq so the words are drawn again for every row, and the
+            # aggregate's argument references g so string_agg belongs to the subquery, not the INSERT
+            conn.execute(text("""
+                WITH words AS (
+                    SELECT array_agg(substr(md5(i::text), 1, 4 + i % 6) ORDER BY i) AS w
+                    FROM generate_series(0, :vocabulary - 1) i)
+                INSERT INTO chat_messages (chat_id, user_id, seq, role, content, created_at)
+                SELECT c.id, c.user_id, s.seq,
+                       CASE WHEN s.seq % 2 = 1 THEN 'user' ELSE 'assistant' END,
+                       (SELECT string_agg(words.w[1 + floor(power(random(), 3) * :vocabulary)::int + 0 * g], ' ')
+                        FROM generate_series(1, :words + 0 * s.seq) g),
+                       now()
+                FROM chats c CROSS JOIN generate_series(1, :messages) s(seq) CROSS JOIN words
+                WHERE c.user_id = ANY(:user_ids)"""),
+                {"vocabulary": args.vocabulary, "words": args.words, "messages": args.messages_per_chat,
+                 "user_ids": batch})
+        done = batch_start + len(batch)
+        print(f"  ... {done}/{len(user_ids)} users, {time.perf_counter() - started:.0f}s")
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ANALYZE chat_messages"))
+        conn.execute(text("ANALYZE chats"))
+        total = conn.execute(text("SELECT count(*) FROM chat_messages")).scalar()
+    print(f"chat_messages now holds {total} rows")
+
+def cleanup():
+    with engine.begin() as conn:
+        conn.execute(text("""
+            DELETE FROM chats WHERE user_id IN (SELECT id FROM users WHERE username LIKE :pattern)"""),
+            {"pattern": USER_PREFIX + "%"})
+        deleted = conn.execute(text("DELETE FROM users WHERE username LIKE :pattern"),
+                               {"pattern": USER_PREFIX + "%"}).rowcount
+    print(f"removed {deleted} bench users and their chats")
+
+async def measure(args):
+    with engine.connect() as conn:
+        user_ids = [row[0] for row in conn.execute(
+            text("SELECT id FROM users WHERE username LIKE :pattern"), {"pattern": USER_PREFIX + "%"})]
+        total = conn.execute(text("SELECT count(*) FROM chat_messages")).scalar()
+    if not user_ids:
+        print("no bench users; run with --seed first")
+        return
+
+    rng = random.Random(5)
+    # Frequent words hit most of a user's messages, rare ones almost none
+    kinds = {
+        "common": lambda: vocabulary_word(rng.randrange(20)),
+        "rare": lambda: vocabulary_word(rng.randrange(args.vocabulary // 2, args.vocabulary)),
+        "two words": lambda: f"{vocabulary_word(rng.randrange(200))} {vocabulary_word(rng.randrange(200))}",
+    }
+    print(f"{total} messages in chat_messages, {len(user_ids)} bench users")
+    async with AsyncSessionLocal() as db:
+        await search_chats(db, user_ids[0], vocabulary_word(1), 10, 0)  # warm the connection
+        for kind, make_query in kinds.items():
+            latencies = []
+            for _ in range(args.queries):
+                user_id = rng.choice(user_ids)
+                started = time.perf_counter()
+                await search_chats(db, user_id, make_query(), 10, 0)
+                latencies.append(time.perf_counter() - started)
+            latencies.sort()
+            print(f"{kind:>9}: p50={statistics.median(latencies) * 1000:.1f}ms  "
+                  f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms  "
+                  f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat history search benchmark")
+    parser.add_argument("--seed", action="store_true")
+    parser.add_argument("--cleanup", action="store_true")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--chats-per-user", type=int, default=50)
+    parser.add_argument("--messages-per-chat", type=int, default=40)
+    parser.add_argument("--words", type=int, default=20)
+    parser.add_argument("--vocabulary", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    if args.cleanup:
+        cleanup()
+    else:
+        if args.seed:
+            seed(args)
+        asyncio.run(measure(args))
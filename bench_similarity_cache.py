@@ -0,0 +1,75 @@
+# bench_similarity_cache.py
+# Lookup cost of the MinHash LSH similarity cache at scale:
+#   python bench_similarity_cache.py --entries 1000000
+# The cache is filled with random signatures (signing a million real prompts only measures
+# the signer), plus a few hundred real prompts that the near-duplicate lookups should find.
+import argparse
+import random
+import resource
+import statistics
+import time
+from array import array
+
+from similarity_cache import SimilarityCache
+
+WORDS = ("account password reset invoice billing plan upgrade export report dashboard team invite "
+         "delete chat history model search upload pdf image limit error login token refund").split()
+
+def make_prompt(rng):
+    return "How do I " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 30))) + "?"
+
+def near_duplicate(prompt, rng):
+    words = prompt.split()
+    words[rng.randrange(len(words))] = rng.choice(WORDS)
+    return "  ".join(words).upper() if rng.random() < 0.5 else " ".join(words)
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return (f"p50={statistics.median(samples) * 1e6:.0f}us  "
+            f"p99={samples[int(len(samples) * 0.99) - 1] * 1e6:.0f}us")
+
+def main(args):
+    rng = random.Random(7)
+    cache = SimilarityCache(threshold=args.threshold, max_size=args.entries)
+    num_perm = cache.bands * cache.rows
+    partition = "bench"
+
+    started = time.perf_counter()
+    for i in range(args.entries - args.real):
+        cache.set_signed(partition, array("I", [rng.getrandbits(32) for _ in range(num_perm)]), i)
+    prompts = [make_prompt(rng) for _ in range(args.real)]
+    for prompt in prompts:
+        cache.set(partition, prompt, prompt)
+    fill = time.perf_counter() - started
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{len(cache)} entries, {num_perm} permutations ({cache.bands}x{cache.rows}), "
+          f"filled in {fill:.1f}s, peak RSS {rss_mb:.0f} MB")
+
+    sign, miss, hit = [], [], []
+    hits = 0
+    for _ in range(args.lookups):
+        text = make_prompt(rng)
+        started = time.perf_counter()
+        signature = cache.sign(text)
+        sign.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        cache.get_signed(partition, signature)
+        miss.append(time.perf_counter() - started)
+
+        original = rng.choice(prompts)
+        started = time.perf_counter()
+        found = cache.get(partition, near_duplicate(original, rng))
+        hit.append(time.perf_counter() - started)
+        hits += found == original
+
+    print(f"sign prompt:          {percentiles(sign)}")
+    print(f"probe, no match:      {percentiles(miss)}")
+    print(f"sign + probe, near-dup: {percentiles(hit)}  (found {hits}/{args.lookups})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Similarity cache lookup benchmark")
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--real", type=int, default=500)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--threshold", type=float, default=0.85)
+    main(parser.parse_args())
@@ -0,0 +1,152 @@
+import math
+import os
+import time
+from collections import deque
+
+# A provider's breaker opens when, over its last BREAKER_WINDOW calls (and at least
+# BREAKER_MIN_CALLS), the share of failures or of calls slower than BREAKER_SLOW_SECONDS
+# reaches BREAKER_FAILURE_RATE. After BREAKER_OPEN_SECONDS one probe call is let through
+# (half-open); its outcome closes the breaker or opens it again.
+BREAKER_ENABLED = os.environ.get("BREAKER_ENABLED", "1") == "1"
+BREAKER_WINDOW = int(os.environ.get("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.environ.get("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_SECONDS = float(os.environ.get("BREAKER_SLOW_SECONDS", "30"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+# Successful call latencies kept per provider and call kind for the hedging delay
+LATENCY_SAMPLES = 200
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"{provider} is temporarily unavailable")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)  # True for a good call
+        self.opened_at = 0.0
+        self.probing = False
+        self.counters = {"calls": 0, "failures": 0, "slow": 0, "rejected": 0, "opened": 0}
+
+    def allow(self):
+        """Whether a call may go out now; in half-open state only the single probe may."""
+        if not BREAKER_ENABLED or self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= BREAKER_OPEN_SECONDS:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self.counters["rejected"] += 1
+        return False
+
+    def retry_after(self):
+        return max(BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at), 0.0)
+
+    def record(self, ok: bool, seconds: float):
+        slow = seconds >= BREAKER_SLOW_SECONDS
+        self.counters["calls"] += 1
+        self.counters["failures"] += not ok
+        self.counters["slow"] += ok and slow
+        good = ok and not slow
+        if self.state == HALF_OPEN and self.probing:
+            self.probing = False
+            if good:
+                self.state = CLOSED
+                self.outcomes.clear()
+            else:
+                self._open()
+            return
+        self.outcomes.append(good)
+        if self.state == CLOSED and len(self.outcomes) >= BREAKER_MIN_CALLS:
+            bad = len(self.outcomes) - sum(self.outcomes)
+            if bad / len(self.outcomes) >= BREAKER_FAILURE_RATE:
+                self._open()
+
+    def abandon(self):
+        """The call was cancelled (e.g. it lost a hedge race); it tells us nothing either way."""
+        if self.state == HALF_OPEN and self.probing:
+            self.probing = False
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        self.counters["opened"] += 1
+
+
+class LatencyTracker:
+    def __init__(self):
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, fraction: float):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(math.ceil(fraction * len(ordered)) - 1, len(ordered) - 1)]
+
+
+class ProviderHealth:
+    """Circuit breakers per provider, plus latency percentiles per provider and call kind."""
+
+    def __init__(self):
+        self.breakers = {}
+        self.latencies = {}
+        # Kept by the hedging in ai.py
+        self.counters = {"hedged": 0, "failed_over": 0, "fallback_answers": 0}
+
+    def breaker(self, provider: str):
+        breaker = self.breakers.get(provider)
+        if breaker is None:
+            breaker = self.breakers[provider] = CircuitBreaker()
+        return breaker
+
+    def is_open(self, provider: str):
+        breaker = self.breakers.get(provider)
+        return (BREAKER_ENABLED and breaker is not None and breaker.state == OPEN
+                and time.monotonic() - breaker.opened_at < BREAKER_OPEN_SECONDS)
+
+    def check(self, provider: str):
+        breaker = self.breaker(provider)
+        if not breaker.allow():
+            raise CircuitOpen(provider, breaker.retry_after())
+
+    def record(self, provider: str, kind: str, ok: bool, seconds: float):
+        self.breaker(provider).record(ok, seconds)
+        if ok:
+            tracker = self.latencies.get((provider, kind))
+            if tracker is None:
+                tracker = self.latencies[(provider, kind)] = LatencyTracker()
+            tracker.add(seconds)
+
+    def abandon(self, provider: str):
+        self.breaker(provider).abandon()
+
+    def p95(self, provider: str, kind: str, min_samples: int = 20):
+        tracker = self.latencies.get((provider, kind))
+        if tracker is None or len(tracker.samples) < min_samples:
+            return None
+        return tracker.percentile(0.95)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "breakers": {provider: {**breaker.counters, "state": breaker.state}
+                         for provider, breaker in self.breakers.items()},
+            "p95_seconds": {f"{provider}/{kind}": round(tracker.percentile(0.95), 3)
+                            for (provider, kind), tracker in self.latencies.items() if tracker.samples},
+        }
+
+
+provider_health = ProviderHealth()
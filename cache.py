@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
+
+from database import AsyncSessionLocal
+from models import LLMResponseCache
+
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "2048"))
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", "3600"))
+# Shares entries between workers through Postgres; off by default since it costs a query per miss.
+LLM_CACHE_SHARED = os.environ.get("LLM_CACHE_SHARED", "0") == "1"
+LLM_CACHE_PURGE_EVERY = 1000
+
+
+class TTLCache:
+    """Thread-safe LRU map whose entries also expire after a per-entry time to live."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def response_cache_key(provider: str, model_name: str, system_prompt: str, messages, allow_search: bool):
+    # `messages` are (role, content) pairs; sorted keys and fixed separators make the JSON canonical
+    canonical = json.dumps({
+        "provider": provider,
+        "model_name": model_name,
+        "system_prompt": system_prompt or "",
+        "messages": [[role, content] for role, content in messages],
+        "allow_search": bool(allow_search),
+    }, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Exact-match cache of successful LLM answers: in-process LRU in front of an optional Postgres tier."""
+
+    def __init__(self, max_size: int = LLM_CACHE_MAX_ENTRIES, ttl: float = LLM_CACHE_TTL,
+                 shared: bool = LLM_CACHE_SHARED):
+        self.local = TTLCache(max_size, ttl)
+        self.ttl = ttl
+        self.shared = shared
+        self.counters = {"local_hits": 0, "shared_hits": 0, "misses": 0, "stores": 0, "bypassed": 0}
+
+    async def get(self, key: str):
+        response = self.local.get(key)
+        if response is not None:
+            self.counters["local_hits"] += 1
+            return response
+
+        if self.shared:
+            try:
+                async with AsyncSessionLocal() as db:
+                    row = (await db.execute(
+                        select(LLMResponseCache.response, LLMResponseCache.expires_at)
+                        .where(LLMResponseCache.cache_key == key,
+                               LLMResponseCache.expires_at > datetime.utcnow())
+                    )).first()
+                if row is not None:
+                    self.counters["shared_hits"] += 1
+                    remaining = (row.expires_at - datetime.utcnow()).total_seconds()
+                    self.local.set(key, row.response, ttl=max(remaining, 0))
+                    return row.response
+            except Exception as e:
+                print(f"Shared LLM cache lookup failed: {e}")
+
+        self.counters["misses"] += 1
+        return None
+
+    async def set(self, key: str, response: str, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, response, ttl=ttl)
+        self.counters["stores"] += 1
+
+        if self.shared:
+            expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(
+                        insert(LLMResponseCache)
+                        .values(cache_key=key, response=response, expires_at=expires_at)
+                        .on_conflict_do_update(index_elements=[LLMResponseCache.cache_key],
+                                               set_={"response": response, "expires_at": expires_at}))
+                    if self.counters["stores"] % LLM_CACHE_PURGE_EVERY == 0:
+                        await db.execute(delete(LLMResponseCache).where(
+                            LLMResponseCache.expires_at <= datetime.utcnow()))
+                    await db.commit()
+            except Exception as e:
+                print(f"Shared LLM cache store failed: {e}")
+
+    def record_bypass(self):
+        self.counters["bypassed"] += 1
+
+    def stats(self):
+        hits = self.counters["local_hits"] + self.counters["shared_hits"]
+        lookups = hits + self.counters["misses"]
+        return {**self.counters, "entries": len(self.local), "max_entries": self.local.max_size,
+                "shared": self.shared, "hit_ratio": round(hits / lookups, 4) if lookups else 0.0}
+
+
+response_cache = ResponseCache()
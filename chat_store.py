@@ -0,0 +1,123 @@
+import re
+from datetime import datetime
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Chat, ChatMessage, UploadedFile, User, DocumentChunk
+from retrieval import chunk_document
+
+# Splits a legacy Chat.messages blob ("User: ...\nAssistant: ...") into turns, with the
+# same rules the Streamlit frontend used to parse it.
+def split_messages(message_string: str):
+    parsed_messages = []
+    if not message_string:
+        return []
+
+    segments = re.split(r'(User:|Assistant:)', message_string)
+    current_role = None
+    current_content = []
+
+    for segment in segments:
+        stripped_segment = segment.strip()
+        if stripped_segment == "User:":
+            if current_role and current_content:
+                parsed_messages.append(
+                    {"role": current_role.lower(), "content": "\n".join(current_content).strip()})
+            current_role = "User"
+            current_content = []
+        elif stripped_segment == "Assistant:":
+            if current_role and current_content:
+                parsed_messages.append(
+                    {"role": current_role.lower(), "content": "\n".join(current_content).strip()})
+            current_role = "Assistant"
+            current_content = []
+        elif stripped_segment != "":
+            current_content.append(stripped_segment)
+
+    if current_role and current_content:
+        parsed_messages.append(
+            {"role": current_role.lower(), "content": "\n".join(current_content).strip()})
+
+    if not parsed_messages and message_string.strip():
+        if message_string.strip().lower().startswith("user:"):
+            parsed_messages.append(
+                {"role": "user", "content": message_string.replace("User:", "", 1).strip()})
+        elif message_string.strip().lower().startswith("assistant:"):
+            parsed_messages.append({"role": "assistant", "content": message_string.replace(
+                "Assistant:", "", 1).strip()})
+        else:
+            parsed_messages.append(
+                {"role": "user", "content": message_string.strip()})
+
+    return parsed_messages
+
+async def append_messages(db: AsyncSession, chat_id: int, user_id: int, message_string: str):
+    """Insert the turns in `message_string` as new rows after the chat's last message.
+
+    The chat row stays locked until the caller commits, so concurrent appends to one chat
+    take turns instead of colliding on the (chat_id, seq) unique index. That index makes
+    the max(seq) lookup a single index probe, so an append costs the same however long the
+    conversation already is. A legacy blob not yet moved by migrate_db.py is moved first.
+    """
+    legacy_blob = await db.scalar(select(Chat.messages).where(Chat.id == chat_id).with_for_update())
+    last_seq = await db.scalar(
+        select(func.coalesce(func.max(ChatMessage.seq), 0)).where(ChatMessage.chat_id == chat_id))
+
+    turns = split_messages(message_string)
+    if legacy_blob and last_seq == 0:
+        turns = split_messages(legacy_blob) + turns
+        await db.execute(update(Chat).where(Chat.id == chat_id).values(messages=None))
+
+    rows = []
+    for offset, msg in enumerate(turns, start=1):
+        rows.append(ChatMessage(
+            chat_id=chat_id,
+            user_id=user_id,
+            seq=last_seq + offset,
+            role=msg["role"],
+            content=msg["content"],
+            created_at=datetime.utcnow()
+        ))
+    db.add_all(rows)
+    return rows
+
+def new_uploaded_file(user_id: int, file_name: str, file_type: str, extracted_text, chat_id: int = None):
+    """Build the UploadedFile row for an extracted upload, with its retrieval chunks."""
+    return UploadedFile(
+        file_name=file_name,
+        file_type=file_type,
+        extracted_text=extracted_text,
+        user_id=user_id,
+        chat_id=chat_id,
+        uploaded_at=datetime.utcnow(),
+        chunks=[DocumentChunk(user_id=user_id, seq=seq, page=page, content=content)
+                for seq, (page, content) in enumerate(chunk_document(file_type, extracted_text), start=1)]
+    )
+
+def new_upload_chat(user_id: int, file_name: str, file_type: str, extracted_text):
+    """Build the chat, first message and UploadedFile rows for an extracted upload.
+
+    Linked through relationships, so a single add() + flush works from both the API's
+    AsyncSession and the ingestion worker's sync Session. The document itself reaches the
+    model through retrieval, so the first message only records the upload.
+    """
+    label = "PDF" if file_type == "pdf" else "Image"
+    note = f"[Uploaded {label}: {file_name}"
+    if file_type == "pdf":
+        note += f", {len(extracted_text['pages'])} pages"
+    return Chat(
+        title=f"{label}: {file_name[:50]}",
+        user_id=user_id,
+        timestamp=datetime.utcnow(),
+        chat_messages=[ChatMessage(user_id=user_id, seq=1, role="user", content=note + "]",
+                                   created_at=datetime.utcnow())],
+        uploaded_files=[new_uploaded_file(user_id, file_name, file_type, extracted_text)]
+    )
+
+async def bump_history_version(db: AsyncSession, user_id: int):
+    # Incremented in SQL so concurrent mutations from several workers never lose a bump
+    await db.execute(
+        update(User).where(User.id == user_id)
+        .values(history_version=User.history_version + 1)
+        .execution_options(synchronize_session=False))
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import ChatSummary
+
+CHARS_PER_TOKEN = 4
+# Tokens of conversation history sent to each model, system prompt included; the rest of the
+# model's window is left for tool output and the answer.
+MODEL_CONTEXT_BUDGETS = {
+    "llama3-70b-8192": 4000,
+    "llama-3.3-70b-versatile": 6000,
+    "mistralai/Mixtral-8x7B-Instruct-v0.1": 6000,
+    "gemini-2.0-flash": 12000,
+}
+DEFAULT_CONTEXT_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "4000"))
+SUMMARY_TOKENS = int(os.environ.get("CONTEXT_SUMMARY_TOKENS", "500"))
+# Folding caps each old message, and each summarizer call, so one huge turn cannot blow up a fold
+FOLD_MESSAGE_TOKENS = 1000
+FOLD_CALL_TOKENS = 6000
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str):
+    # Tokenizer-free estimate; English text averages close to 4 characters per token
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_to_tokens(text: str, tokens: int, keep_end: bool = False):
+    max_chars = max(tokens, 0) * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return "[...] " + text[-max_chars:] if keep_end else text[:max_chars] + " [...]"
+
+
+def context_budget(model_name: str):
+    return MODEL_CONTEXT_BUDGETS.get(model_name, DEFAULT_CONTEXT_BUDGET)
+
+
+def as_dict(msg):
+    if isinstance(msg, dict):
+        return {"role": msg["role"], "content": msg["content"]}
+    return {"role": msg.role, "content": msg.content}
+
+
+def prefix_hash(messages: list):
+    canonical = json.dumps([[m["role"], m["content"]] for m in messages], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def recent_start(messages: list, budget: int):
+    """Index of the first message of the longest tail of `messages` that fits in `budget` tokens."""
+    used = 0
+    start = len(messages)
+    while start > 0:
+        cost = estimate_tokens(messages[start - 1]["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    return start
+
+
+async def fold_turns(summary: str, turns: list, summarize):
+    """Extend `summary` with `turns`, one summarizer call per FOLD_CALL_TOKENS of input."""
+    chunk, chunk_tokens = [], 0
+    for index, msg in enumerate(turns):
+        line = f"{msg['role'].capitalize()}: {truncate_to_tokens(msg['content'], FOLD_MESSAGE_TOKENS)}"
+        chunk.append(line)
+        chunk_tokens += estimate_tokens(line)
+        if chunk_tokens >= FOLD_CALL_TOKENS or index == len(turns) - 1:
+            summary = await summarize(summary, "\n".join(chunk), SUMMARY_TOKENS * 3 // 4)
+            if summary is None:
+                return None
+            summary = truncate_to_tokens(summary, SUMMARY_TOKENS)
+            chunk, chunk_tokens = [], 0
+    return summary
+
+
+async def build_context(db: AsyncSession, chat_id, messages: list, system_prompt: str, budget: int, summarize):
+    """Fit a conversation into `budget` tokens and return the (system_prompt, messages) to send.
+
+    Newest messages are kept verbatim. Older ones are folded into a rolling summary appended to
+    the system prompt; it is stored per chat and only extended with the turns that aged out
+    since the previous fold. Each fold goes down to half the window, so the next few turns fit
+    without another summarizer call. `summarize(summary, turns_text, max_words)` returns the
+    updated summary, or None if it failed, in which case the overflow is dropped this time.
+    """
+    messages = [as_dict(m) for m in messages]
+    window = max(budget - estimate_tokens(system_prompt or "") - SUMMARY_TOKENS, 256)
+    if messages:
+        messages[-1]["content"] = truncate_to_tokens(messages[-1]["content"], window - MESSAGE_OVERHEAD_TOKENS)
+    start = recent_start(messages, window)
+    if start == 0:
+        return system_prompt, messages
+
+    summary, covered = "", 0
+    row = await db.get(ChatSummary, chat_id) if chat_id else None
+    # Not held open through the summarizer call, which can take seconds
+    await db.commit()
+    # A summary written for a bigger budget may cover less than `start`, one for a smaller budget more
+    if row and row.covered_count < len(messages) and row.covered_hash == prefix_hash(messages[:row.covered_count]):
+        summary, covered = row.summary, row.covered_count
+
+    if covered < start:
+        fold_to = min(max(start, recent_start(messages, window // 2)), len(messages) - 1)
+        folded = await fold_turns(summary, messages[covered:fold_to], summarize)
+        if folded is not None:
+            summary, covered = folded, fold_to
+            if chat_id:
+                values = {"summary": summary, "covered_count": covered,
+                          "covered_hash": prefix_hash(messages[:covered]), "updated_at": datetime.utcnow()}
+                await db.execute(insert(ChatSummary).values(chat_id=chat_id, **values)
+                                 .on_conflict_do_update(index_elements=[ChatSummary.chat_id], set_=values))
+                await db.commit()
+
+    if summary:
+        system_prompt = f"{system_prompt}\n\nSummary of the earlier conversation:\n{summary}"
+    return system_prompt, messages[max(covered, start):]
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Total time a chat request may take, unless the client asks for less (or, up to the max, more)
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "60"))
+MAX_REQUEST_DEADLINE_SECONDS = float(os.environ.get("MAX_REQUEST_DEADLINE_SECONDS", "120"))
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, message: str = "The request ran out of time"):
+        super().__init__(message)
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def for_request(cls, requested: float = None):
+        seconds = REQUEST_DEADLINE_SECONDS if not requested or requested <= 0 else requested
+        return cls(min(seconds, MAX_REQUEST_DEADLINE_SECONDS))
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+
+# The deadline of the request being served; asyncio tasks inherit it from whoever created them
+current_deadline = ContextVar("current_deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(deadline: Deadline):
+    token = current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining(default: float = None):
+    """Seconds left for the current request, or `default` outside of one."""
+    deadline = current_deadline.get()
+    return default if deadline is None else deadline.remaining()
+
+
+def capped(timeout: float, reserve: float = 0.0):
+    """`timeout`, shortened to what the current request has left after keeping back `reserve` seconds."""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return timeout
+    left = max(deadline.remaining() - reserve, 0.0)
+    return left if timeout is None else min(timeout, left)
+
+
+async def within_deadline(awaitable):
+    """Await `awaitable`, cancelling it and raising DeadlineExceeded if the request runs out of time."""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return await awaitable
+    if deadline.expired():
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded()
+    try:
+        return await asyncio.wait_for(awaitable, deadline.remaining())
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded()
+
+
+async def iterate_within_deadline(iterator):
+    """Yield from the async `iterator` until the current request's deadline.
+
+    The iterator runs in a task of its own that is cancelled when time runs out, so a stream
+    stalled waiting on a provider can be cut off without touching it from another task.
+    """
+    deadline = current_deadline.get()
+    if deadline is None:
+        async for item in iterator:
+            yield item
+        return
+
+    queue = asyncio.Queue()
+    finished = object()
+
+    async def produce():
+        try:
+            async for item in iterator:
+                await queue.put((item, None))
+            await queue.put((finished, None))
+        except Exception as e:
+            await queue.put((finished, e))
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            try:
+                item, error = await asyncio.wait_for(queue.get(), deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded()
+            if item is finished:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        producer.cancel()
+        try:
+            await producer
+        except (asyncio.CancelledError, Exception):
+            pass
@@ -1,10 +1,8 @@
 import streamlit as st
 import requests
-import time
 import os
-import re
-from datetime import datetime
-import PyPDF2
+import json
+import time
 import io
 
 # Set page config once at the very top
@@ -13,6 +11,8 @@ st.set_page_config(page_title="LangGraph Chatbot",
 
 # === Constants ===
 BACKEND_URL = "http://127.0.0.1:8000"
+# A streamed answer is redrawn at most this often; each redraw sends the whole bubble again
+STREAM_RENDER_INTERVAL = 0.25
 
 # === Initialize Session State ===
 defaults = {
@@ -24,11 +24,14 @@ defaults = {
     "last_input": "",
     "session_token": "",
     "chat_history": [],
+    "history_next_cursor": None,
+    "history_etag": "",
+    "history_version": "",
     "current_chat_id": None,
     "current_chat_title": "New Chat",
     "displayed_chat_count": 15,
     "awaiting_ai_response": False,
-    "uploaded_pdf_content": "",
+    "attached_documents": [],
 }
 for key, val in defaults.items():
     if key not in st.session_state:
@@ -54,88 +57,140 @@ if not st.session_state.authenticated and st.session_state.session_token:
         st.session_state.session_token = ""
         st.query_params["token"] = ""
 
-# === Helper to parse messages from backend string format ===
-def parse_backend_messages(message_string: str):
-    parsed_messages = []
-    if not message_string:
-        return []
-
-    segments = re.split(r'(User:|Assistant:)', message_string)
-    current_role = None
-    current_content = []
-
-    for i, segment in enumerate(segments):
-        stripped_segment = segment.strip()
-        if stripped_segment == "User:":
-            if current_role and current_content:
-                parsed_messages.append(
-                    {"role": current_role.lower(), "content": "\n".join(current_content).strip()})
-            current_role = "User"
-            current_content = []
-        elif stripped_segment == "Assistant:":
-            if current_role and current_content:
-                parsed_messages.append(
-                    {"role": current_role.lower(), "content": "\n".join(current_content).strip()})
-            current_role = "Assistant"
-            current_content = []
-        elif stripped_segment != "":
-            current_content.append(stripped_segment)
-
-    if current_role and current_content:
-        parsed_messages.append(
-            {"role": current_role.lower(), "content": "\n".join(current_content).strip()})
-
-    if not parsed_messages and message_string.strip():
-        if message_string.strip().lower().startswith("user:"):
-            parsed_messages.append(
-                {"role": "user", "content": message_string.replace("User:", "", 1).strip()})
-        elif message_string.strip().lower().startswith("assistant:"):
-            parsed_messages.append({"role": "assistant", "content": message_string.replace(
-                "Assistant:", "", 1).strip()})
-        else:
-            parsed_messages.append(
-                {"role": "user", "content": message_string.strip()})
-
-    return parsed_messages
+# === PDF Upload ===
+def upload_document(pdf_file):
+    """Upload a PDF to the current chat (or a new one) and wait until the backend has extracted it.
 
-# === PDF Processing Function ===
-def extract_text_from_pdf(pdf_file):
-    """Extract text content from uploaded PDF file"""
+    The backend indexes the text and adds the relevant parts to each question, so the
+    document is never sent along with the messages.
+    """
+    headers = {"Authorization": f"Bearer {st.session_state.session_token}"}
+    data = {"chat_id": st.session_state.current_chat_id} if st.session_state.current_chat_id else {}
     try:
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text_content = ""
-        
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            text_content += page.extract_text() + "\n"
-        
-        return text_content.strip()
+        res = requests.post(f"{BACKEND_URL}/upload-pdf-to-chat/", headers=headers, data=data,
+                            files={"file": (pdf_file.name, pdf_file.getvalue(), "application/pdf")})
+        if res.status_code != 202:
+            st.error(f"Failed to upload PDF: {res.text}")
+            return None
+        job = res.json()
+        progress = st.progress(0.0)
+        while job["status"] in ("queued", "running"):
+            time.sleep(1)
+            res = requests.get(f"{BACKEND_URL}/ingest-jobs/{job['job_id']}", headers=headers)
+            if res.status_code != 200:
+                st.error(f"Failed to check PDF status: {res.text}")
+                return None
+            job = res.json()
+            if job.get("pages_total"):
+                progress.progress(min(job["pages_done"] / job["pages_total"], 1.0))
+        if job["status"] != "done":
+            st.error(f"Failed to process PDF: {job.get('error')}")
+            return None
+        return job
     except Exception as e:
-        st.error(f"Error reading PDF: {e}")
-        return ""
+        st.error(f"Error uploading PDF: {e}")
+        return None
 
 # === Fetch Chat History ===
+HISTORY_PAGE_SIZE = 15
+
 def fetch_chat_history():
+    """Revalidate the cached chat list through its first page; the backend answers 304 while nothing has changed.
+
+    When something did change, the list is reloaded as far down as the user had shown.
+    """
     if st.session_state.authenticated:
         headers = {"Authorization": f"Bearer {st.session_state.session_token}"}
+        validators = {"If-None-Match": st.session_state.history_etag} if st.session_state.history_etag else {}
         try:
-            res = requests.get(f"{BACKEND_URL}/history", headers=headers)
+            res = requests.get(f"{BACKEND_URL}/history", headers={**headers, **validators},
+                               params={"limit": HISTORY_PAGE_SIZE})
+            if res.status_code == 304:
+                return
             if res.status_code == 200:
-                st.session_state.chat_history = res.json()
+                data = res.json()
+                items, next_cursor = data["items"], data["next_cursor"]
+                while next_cursor and len(items) < st.session_state.displayed_chat_count:
+                    more = requests.get(f"{BACKEND_URL}/history", headers=headers, params={
+                        "limit": min(st.session_state.displayed_chat_count - len(items), 100),
+                        "cursor": next_cursor})
+                    more.raise_for_status()
+                    page = more.json()
+                    items.extend(page["items"])
+                    next_cursor = page["next_cursor"]
+                st.session_state.chat_history = items
+                st.session_state.history_next_cursor = next_cursor
+                st.session_state.history_etag = res.headers.get("ETag", "")
+                st.session_state.history_version = res.headers.get("X-History-Version", "")
             else:
                 st.session_state.chat_history = []
+                st.session_state.history_next_cursor = None
+                st.session_state.history_etag = ""
                 st.error(f"Failed to fetch chat history: {res.text}")
         except Exception as e:
             st.error(f"Error fetching chat history: {e}")
             st.session_state.chat_history = []
+            st.session_state.history_next_cursor = None
+            st.session_state.history_etag = ""
+
+def fetch_more_chat_history():
+    if st.session_state.authenticated and st.session_state.history_next_cursor:
+        headers = {"Authorization": f"Bearer {st.session_state.session_token}"}
+        try:
+            res = requests.get(f"{BACKEND_URL}/history", headers=headers,
+                               params={"limit": HISTORY_PAGE_SIZE, "cursor": st.session_state.history_next_cursor})
+            if res.status_code == 200:
+                data = res.json()
+                st.session_state.chat_history.extend(data["items"])
+                st.session_state.history_next_cursor = data["next_cursor"]
+                st.session_state.displayed_chat_count += HISTORY_PAGE_SIZE
+                # Pages have ETags of their own; the version says whether the list changed since
+                # the first page was cached, and if so it is reloaded on the next render
+                if res.headers.get("X-History-Version") != st.session_state.history_version:
+                    st.session_state.history_etag = ""
+            else:
+                st.error(f"Failed to fetch more chats: {res.text}")
+        except Exception as e:
+            st.error(f"Error fetching more chats: {e}")
+
+# === Fetch a single chat with its messages ===
+def fetch_chat(chat_id: int):
+    headers = {"Authorization": f"Bearer {st.session_state.session_token}"}
+    try:
+        res = requests.get(f"{BACKEND_URL}/history/{chat_id}", headers=headers)
+        if res.status_code == 200:
+            return res.json()
+        if res.status_code != 404:
+            st.error(f"Failed to load chat: {res.text}")
+    except Exception as e:
+        st.error(f"Error loading chat: {e}")
+    return None
+
+# === Search Chats ===
+def search_chats(query: str):
+    """Full-text search over the user's chats and uploaded documents, best matches first."""
+    headers = {"Authorization": f"Bearer {st.session_state.session_token}"}
+    try:
+        res = requests.get(f"{BACKEND_URL}/history/search", headers=headers,
+                           params={"q": query, "limit": 20})
+        if res.status_code == 200:
+            return res.json()["items"]
+        st.error(f"Search failed: {res.text}")
+    except Exception as e:
+        st.error(f"Error searching chats: {e}")
+    return []
 
 # === Load Chat by ID ===
-def load_chat(chat_id: int, chat_title: str, messages_string: str):
+def load_chat(chat_id: int, chat_title: str):
+    chat = fetch_chat(chat_id)
+    if chat is None:
+        return
     st.session_state.current_chat_id = chat_id
-    st.session_state.current_chat_title = chat_title
-    st.session_state.messages = parse_backend_messages(messages_string)
+    st.session_state.current_chat_title = chat.get("title") or chat_title
+    st.session_state.messages = chat["messages"]
     st.session_state.chat_started = True
     st.session_state.awaiting_ai_response = False
+    st.session_state.attached_documents = []
     st.rerun()
 
 # === Delete Chat ===
@@ -147,7 +202,6 @@ def delete_chat_action(chat_id: int):
                 f"{BACKEND_URL}/history/{chat_id}", headers=headers)
             if res.status_code == 200:
                 st.success("Chat deleted successfully!")
-                fetch_chat_history()
                 if st.session_state.current_chat_id == chat_id:
                     st.session_state.messages = []
                     st.session_state.current_chat_id = None
@@ -169,7 +223,6 @@ def rename_chat_logic(chat_id: int, current_title: str, new_title: str):
                                headers=headers, params={"new_title": new_title})
             if res.status_code == 200:
                 st.success("Chat renamed successfully!")
-                fetch_chat_history()
                 if st.session_state.current_chat_id == chat_id:
                     st.session_state.current_chat_title = new_title
                 st.session_state[f'show_rename_input_{chat_id}'] = False
@@ -181,12 +234,12 @@ def rename_chat_logic(chat_id: int, current_title: str, new_title: str):
 
 # === Logout ===
 def logout():
-    for key in ["authenticated", "user_email", "messages", "chat_started", "last_input", "session_token", "chat_history", "current_chat_id", "current_chat_title", "displayed_chat_count", "awaiting_ai_response", "uploaded_pdf_content"]:
+    for key in ["authenticated", "user_email", "messages", "chat_started", "last_input", "session_token", "chat_history", "history_next_cursor", "history_etag", "history_version", "current_chat_id", "current_chat_title", "displayed_chat_count", "awaiting_ai_response", "attached_documents"]:
         if key == "authenticated" or key == "chat_started" or key == "awaiting_ai_response":
             st.session_state[key] = False
-        elif key == "messages" or key == "chat_history":
+        elif key == "messages" or key == "chat_history" or key == "attached_documents":
             st.session_state[key] = []
-        elif key == "current_chat_id":
+        elif key == "current_chat_id" or key == "history_next_cursor":
             st.session_state[key] = None
         elif key == "displayed_chat_count":
             st.session_state[key] = 15
@@ -303,12 +356,9 @@ def chat_app():
 
         # Logic to restore ongoing chat on refresh or initial load
         if st.session_state.authenticated and st.session_state.current_chat_id is not None and not st.session_state.messages:
-            fetch_chat_history()  # Ensure chat_history is up-to-date
-            found_chat = next(
-                (chat for chat in st.session_state.chat_history if chat['id'] == st.session_state.current_chat_id), None)
+            found_chat = fetch_chat(st.session_state.current_chat_id)
             if found_chat:
-                st.session_state.messages = parse_backend_messages(
-                    found_chat['messages'])
+                st.session_state.messages = found_chat['messages']
                 st.session_state.current_chat_title = found_chat['title']
                 st.session_state.chat_started = True
                 st.session_state.awaiting_ai_response = False
@@ -327,7 +377,7 @@ def chat_app():
             st.session_state.current_chat_title = "New Chat"
             st.session_state.chat_started = False
             st.session_state.awaiting_ai_response = False
-            st.session_state.uploaded_pdf_content = ""
+            st.session_state.attached_documents = []
             st.rerun()
 
         st.markdown("---")
@@ -337,45 +387,53 @@ def chat_app():
         uploaded_file = st.file_uploader(
             "Choose a PDF file", 
             type="pdf", 
-            help="Upload a PDF file to include its content in your chat"
+            help="Upload a PDF file to ask questions about it in this chat"
         )
         
         if uploaded_file is not None:
             if st.button("Process PDF", use_container_width=True):
                 with st.spinner("Processing PDF..."):
-                    pdf_content = extract_text_from_pdf(uploaded_file)
-                    if pdf_content:
-                        st.session_state.uploaded_pdf_content = pdf_content
-                        st.success(f"PDF processed! {len(pdf_content)} characters extracted.")
-                    else:
-                        st.error("Failed to extract text from PDF.")
+                    job = upload_document(uploaded_file)
+                if job:
+                    st.session_state.attached_documents.append(uploaded_file.name)
+                    if not st.session_state.current_chat_id:
+                        # The upload started a new chat; the restore block above loads it on rerun
+                        st.session_state.current_chat_id = job["chat_id"]
+                        st.session_state.messages = []
+                        st.rerun()
+                    st.success(f"PDF processed! {job.get('pages_total') or 0} pages indexed.")
         
-        if st.session_state.uploaded_pdf_content:
-            st.info(f"PDF content loaded ({len(st.session_state.uploaded_pdf_content)} chars)")
-            if st.button("Clear PDF", use_container_width=True):
-                st.session_state.uploaded_pdf_content = ""
-                st.rerun()
+        if st.session_state.attached_documents:
+            st.info("Documents in this chat: " + ", ".join(st.session_state.attached_documents))
         
         st.markdown("---")
+        search_query = st.text_input("🔍 Search chats", key="chat_search_query",
+                                     placeholder="Words from a message or document")
+        if search_query.strip():
+            results = search_chats(search_query.strip())
+            if not results:
+                st.info("No matching chats.")
+            for result in results:
+                snippet = result["snippet"].replace("<mark>", "**").replace("</mark>", "**")
+                if st.button(result["title"] or "Untitled", key=f"search_load_{result['id']}",
+                             use_container_width=True):
+                    load_chat(result["id"], result["title"])
+                st.caption(snippet)
+            st.markdown("---")
+
         st.write("Your Past Chats:")
-        # Always fetch history here to ensure the sidebar is up-to-date
+        # Cheap when nothing changed: a conditional request answered with 304
         fetch_chat_history()
 
-        if st.session_state.chat_history:
-            try:
-                # Sort by timestamp, newest on top
-                sorted_history = sorted(
-                    st.session_state.chat_history,
-                    key=lambda x: datetime.fromisoformat(
-                        x.get('timestamp', '1970-01-01T00:00:00') or '1970-01-01T00:00:00'),
-                    reverse=True
-                )
-            except Exception as e:
-                st.warning(
-                    f"Error sorting chat history by timestamp: {e}. Displaying as is.")
-                sorted_history = st.session_state.chat_history
+        # New chats start with a provisional title; the generated one arrives through history
+        current_chat = next(
+            (chat for chat in st.session_state.chat_history if chat['id'] == st.session_state.current_chat_id), None)
+        if current_chat:
+            st.session_state.current_chat_title = current_chat['title']
 
-            for chat in sorted_history[:st.session_state.displayed_chat_count]:
+        if st.session_state.chat_history:
+            # The backend already returns chats newest first
+            for chat in st.session_state.chat_history:
                 chat_id = chat['id']
                 chat_title = chat['title']
                 is_renaming = st.session_state.get(
@@ -390,8 +448,8 @@ def chat_app():
                     with col1:
                         # Truncate long titles to prevent overflow
                         display_title = chat_title[:30] + "..." if len(chat_title) > 30 else chat_title
-                        if st.button(display_title, key=f"chat_load_{chat_id}", use_container_width=True, help=chat_title):
-                            load_chat(chat_id, chat_title, chat['messages'])
+                        if st.button(display_title, key=f"chat_load_{chat_id}", use_container_width=True, help=chat.get("preview") or chat_title):
+                            load_chat(chat_id, chat_title)
                     with col2:
                         if st.button("✏️", key=f"rename_toggle_{chat_id}", help="Rename Chat"):
                             st.session_state[f'show_rename_input_{chat_id}'] = not is_renaming
@@ -408,9 +466,9 @@ def chat_app():
                             rename_chat_logic(
                                 chat_id, chat_title, new_title_input)
 
-            if st.session_state.displayed_chat_count < len(sorted_history):
+            if st.session_state.history_next_cursor:
                 if st.button("Show More Chats", key="show_more_chats", use_container_width=True):
-                    st.session_state.displayed_chat_count += 15
+                    fetch_more_chat_history()
                     st.rerun()
         else:
             st.info("No chat history yet. Start a new chat!")
@@ -476,16 +534,11 @@ def chat_app():
     if user_input:
         st.session_state.chat_started = True
         
-        # Include PDF content if available
-        final_input = user_input
-        if st.session_state.uploaded_pdf_content:
-            final_input = f"[PDF Content]: {st.session_state.uploaded_pdf_content}\n\n[User Question]: {user_input}"
-        
         st.session_state.messages.append(
-            {"role": "user", "content": user_input})  # Store original user input for display
+            {"role": "user", "content": user_input})
         st.session_state.awaiting_ai_response = True
 
-        message_for_backend = f"User: {final_input}"  # Send enhanced input to backend
+        message_for_backend = f"User: {user_input}"
         chat_id_to_send = st.session_state.current_chat_id
 
         headers = {"Authorization": f"Bearer {st.session_state.session_token}"}
@@ -506,7 +559,6 @@ def chat_app():
                 if saved_chat_data.get("title"):
                     st.session_state.current_chat_title = saved_chat_data.get(
                         "title")
-                fetch_chat_history()  # Refresh history to show new chat/updated entry
             else:
                 st.warning(
                     f"Failed to save user message to chat history: {save_chat_res.text}")
@@ -516,26 +568,56 @@ def chat_app():
         st.rerun()
 
     if st.session_state.awaiting_ai_response and st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
-        # Prepare messages for AI, including PDF content if available
+        # Document excerpts for chats with uploads are added by the backend
         messages_for_ai = st.session_state.messages.copy()
-        if st.session_state.uploaded_pdf_content and messages_for_ai:
-            # Enhance the last user message with PDF content for AI processing
-            last_message = messages_for_ai[-1]
-            enhanced_content = f"[PDF Content]: {st.session_state.uploaded_pdf_content}\n\n[User Question]: {last_message['content']}"
-            messages_for_ai[-1] = {"role": "user", "content": enhanced_content}
-        
+
         payload = {
             "model_name": selected_model,
             "model_provider": provider,
             "system_prompt": system_prompt,
             "messages": messages_for_ai,
-            "allow_search": allow_web_search
+            "allow_search": allow_web_search,
+            "chat_id": st.session_state.current_chat_id
         }
+        headers = {"Authorization": f"Bearer {st.session_state.session_token}"}
         with st.spinner("🤖 Thinking..."):
             try:
-                res = requests.post(f"{BACKEND_URL}/chat-ai", json=payload)
-                if res.status_code == 200:
-                    answer = res.json().get("response", "⚠ No response.")
+                res = requests.post(f"{BACKEND_URL}/chat-ai/stream", json=payload, headers=headers, stream=True)
+                if res.status_code == 200 and res.headers.get("content-type", "").startswith("text/event-stream"):
+                    # Render provider tokens as they arrive
+                    placeholder = st.empty()
+                    chunks = []
+                    stream_error = None
+                    rendered_at = 0.0
+                    rendered_chunks = 0
+
+                    def render_answer():
+                        placeholder.markdown(f"""
+                            <div class='message-wrapper assistant-wrapper'>
+                                <div class='assistant-bubble'>{"".join(chunks)}</div>
+                            </div>
+                        """, unsafe_allow_html=True)
+
+                    for line in res.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith("data: "):
+                            continue
+                        event = json.loads(line[len("data: "):])
+                        if event["type"] == "token":
+                            chunks.append(event["content"])
+                            # Throttled: one redraw per token would be quadratic in the answer length
+                            if time.monotonic() - rendered_at >= STREAM_RENDER_INTERVAL:
+                                render_answer()
+                                rendered_at, rendered_chunks = time.monotonic(), len(chunks)
+                        elif event["type"] == "error":
+                            stream_error = event["error"]
+                        elif event["type"] == "done":
+                            break
+                    if len(chunks) > rendered_chunks:
+                        render_answer()
+
+                    answer = "".join(chunks)
+                    if not answer:
+                        answer = f"❌ Error: {stream_error}" if stream_error else "⚠ No response."
 
                     st.session_state.messages.append(
                         {"role": "assistant", "content": answer})
@@ -552,21 +634,15 @@ def chat_app():
                                       "chat_id": st.session_state.current_chat_id},
                                 headers=headers
                             )
-                            fetch_chat_history()
                         except Exception as e:
                             st.warning(
                                 f"Error saving assistant message to chat history: {e}")
 
-                    # Typing animation
-                    placeholder = st.empty()
-                    for i in range(1, len(answer) + 1):
-                        placeholder.markdown(f"""
-                            <div class='message-wrapper assistant-wrapper'>
-                                <div class='assistant-bubble'>{answer[:i]}</div>
-                            </div>
-                        """, unsafe_allow_html=True)
-                        time.sleep(0.003)
-
+                elif res.status_code == 429:
+                    answer = (f"⏳ You're sending requests too quickly. "
+                              f"Please wait {res.headers.get('Retry-After', 'a few')} seconds and try again.")
+                    st.session_state.messages.append(
+                        {"role": "assistant", "content": answer})
                 else:
                     answer = "❌ Error: backend not responding."
                     st.session_state.messages.append(
@@ -0,0 +1,220 @@
+# ingest_worker.py
+# Processes uploads queued by the API. Run as many as the machine can take:
+#   python ingest_worker.py
+# Each worker OCRs one document at a time over its own OCR process pool.
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import ocr
+from chat_store import new_upload_chat, new_uploaded_file
+from database import engine
+from metrics import metrics, serve_metrics
+from models import IngestionJob, User, ExtractionCache, Chat
+
+POLL_INTERVAL = float(os.environ.get("INGEST_POLL_INTERVAL", "1"))
+# A running job whose heartbeat is older than this belonged to a worker that died
+STALE_AFTER = timedelta(seconds=float(os.environ.get("INGEST_STALE_AFTER", "300")))
+# How often a running job's heartbeat is refreshed; well under STALE_AFTER, whatever the OCR is doing
+HEARTBEAT_INTERVAL = float(os.environ.get("INGEST_HEARTBEAT_INTERVAL", "30"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Port this worker serves /metrics on; 0 turns it off. Give each worker on a machine its own.
+INGEST_METRICS_PORT = int(os.environ.get("INGEST_METRICS_PORT", "9101"))
+
+JOB_SECONDS = metrics.histogram("ingest_job_seconds", "Time to extract and store one uploaded document",
+                                ("file_type", "status"),
+                                buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200))
+
+
+def claim_job(db: Session):
+    stale_before = datetime.utcnow() - STALE_AFTER
+    job = db.scalar(
+        select(IngestionJob)
+        .where(or_(IngestionJob.status == "queued",
+                   and_(IngestionJob.status == "running", IngestionJob.updated_at < stale_before)))
+        .order_by(IngestionJob.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    if job is None:
+        db.rollback()
+        return None
+    job.status = "running"
+    job.claimed_by = WORKER_ID
+    job.updated_at = datetime.utcnow()
+    db.commit()
+    return job
+
+
+def owned(job_id: int):
+    # False once the job has been reclaimed by another worker as stale
+    return and_(IngestionJob.id == job_id, IngestionJob.status == "running", IngestionJob.claimed_by == WORKER_ID)
+
+
+def report_progress(job_id: int, pages_done: int, pages_total: int):
+    # Separate short transaction so status polls see progress while the job is still running
+    with Session(engine) as db:
+        db.execute(update(IngestionJob).where(owned(job_id)).values(
+            pages_done=pages_done, pages_total=pages_total, updated_at=datetime.utcnow()))
+        db.commit()
+
+
+class Heartbeat:
+    """Refreshes a running job's updated_at from a thread, so a long OCR or hashing pass never looks stale."""
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"heartbeat-{job_id}", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                with Session(engine) as db:
+                    db.execute(update(IngestionJob).where(owned(self.job_id)).values(updated_at=datetime.utcnow()))
+                    db.commit()
+            except Exception as e:
+                print(f"Heartbeat for job {self.job_id} failed: {e}")
+
+
+def cache_get_many(db: Session, kind: str, hashes):
+    if not hashes:
+        return {}
+    rows = db.execute(select(ExtractionCache.content_hash, ExtractionCache.extracted_text)
+                      .where(ExtractionCache.kind == kind, ExtractionCache.content_hash.in_(hashes)))
+    return dict(rows.all())
+
+
+def cache_put_many(db: Session, kind: str, texts: dict):
+    if not texts:
+        return
+    # Another worker may have extracted the same content meanwhile; either copy will do.
+    db.execute(insert(ExtractionCache).values([
+        {"kind": kind, "content_hash": h, "extracted_text": t, "created_at": datetime.utcnow()}
+        for h, t in texts.items()
+    ]).on_conflict_do_nothing())
+
+
+class PageCache:
+    """Per-page OCR cache for ocr.extract_pdf_pages; commits each batch so it survives a failed job."""
+
+    def get_many(self, hashes):
+        with Session(engine) as db:
+            return cache_get_many(db, "page", hashes)
+
+    def put_many(self, texts: dict):
+        with Session(engine) as db:
+            cache_put_many(db, "page", texts)
+            db.commit()
+
+
+def extract(db: Session, job: IngestionJob):
+    # The API already answers repeat uploads from the cache, but identical files queued
+    # before the first one finished still end up here.
+    cached = cache_get_many(db, job.file_type, [job.content_hash]) if job.content_hash else {}
+    if job.content_hash in cached:
+        extracted_text = cached[job.content_hash]
+        pages_total = len(extracted_text["pages"]) if job.file_type == "pdf" else 1
+        report_progress(job.id, pages_total, pages_total)
+        return extracted_text
+
+    if job.file_type == "pdf":
+        pages = ocr.extract_pdf_pages(
+            job.payload, on_progress=lambda done, total: report_progress(job.id, done, total),
+            page_cache=PageCache())
+        extracted_text = {"pages": pages}
+    else:
+        report_progress(job.id, 0, 1)
+        extracted_text = ocr.extract_image_text(job.payload)
+        report_progress(job.id, 1, 1)
+
+    if job.content_hash:
+        cache_put_many(db, job.file_type, {job.content_hash: extracted_text})
+    return extracted_text
+
+
+def store_result(db: Session, job: IngestionJob, extracted_text):
+    # The target chat may have been deleted while the document was being extracted
+    if job.chat_id is not None and db.get(Chat, job.chat_id) is not None:
+        uploaded_file = new_uploaded_file(job.user_id, job.file_name, job.file_type, extracted_text, job.chat_id)
+        db.add(uploaded_file)
+        db.flush()
+        job.file_id = uploaded_file.id
+        return
+
+    chat = new_upload_chat(job.user_id, job.file_name, job.file_type, extracted_text)
+    db.add(chat)
+    db.flush()
+
+    db.execute(update(User).where(User.id == job.user_id)
+               .values(history_version=User.history_version + 1))
+    job.chat_id = chat.id
+    job.file_id = chat.uploaded_files[0].id
+
+
+def finish(db: Session, job_id: int, status: str, error: str = None):
+    """Mark the job finished if this worker still owns it; the row stays locked until commit."""
+    now = datetime.utcnow()
+    result = db.execute(update(IngestionJob).where(owned(job_id)).values(
+        status=status, error=error, payload=None, finished_at=now, updated_at=now))
+    return result.rowcount == 1
+
+
+def process(db: Session, job: IngestionJob):
+    started = time.perf_counter()
+    job_id, file_type = job.id, job.file_type
+    try:
+        with Heartbeat(job_id):
+            extracted_text = extract(db, job)
+        if finish(db, job_id, "done"):
+            store_result(db, job, extracted_text)
+            status = "done"
+        else:
+            status = "reclaimed"
+    except Exception as e:
+        db.rollback()
+        traceback.print_exc()
+        status = "failed" if finish(db, job_id, "failed", str(e)) else "reclaimed"
+    if status == "reclaimed":
+        # Another worker took the job over as stale and will store its own result
+        db.rollback()
+        print(f"Job {job_id} was reclaimed by another worker; result discarded")
+    else:
+        db.commit()
+    JOB_SECONDS.labels(file_type, status).observe(time.perf_counter() - started)
+
+
+def run():
+    print(f"📥 Ingestion worker {os.getpid()} started ({ocr.OCR_WORKERS} OCR processes)")
+    if INGEST_METRICS_PORT:
+        serve_metrics(INGEST_METRICS_PORT)
+    try:
+        while True:
+            with Session(engine) as db:
+                job = claim_job(db)
+                if job is None:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                print(f"Processing job {job.id} ({job.file_type}: {job.file_name})")
+                process(db, job)
+    finally:
+        ocr.shutdown()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,119 @@
+import os
+import threading
+from collections import OrderedDict
+
+import httpx
+from langchain_together import ChatTogether
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_groq import ChatGroq
+
+LLM_REGISTRY_MAX_SIZE = int(os.environ.get("LLM_REGISTRY_MAX_SIZE", "16"))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_HTTP_KEEPALIVE_EXPIRY", "120"))
+HTTP_TIMEOUT = float(os.environ.get("LLM_HTTP_TIMEOUT", "60"))
+
+PROVIDER_BASE_URLS = {
+    "Groq": "https://api.groq.com",
+    "TogetherAI": "https://api.together.xyz",
+}
+
+# Models the API serves out of the box; their clients are built at startup.
+DEFAULT_MODELS = [
+    ("Groq", "llama-3.3-70b-versatile"),
+    ("Gemini", "gemini-2.0-flash"),
+    ("TogetherAI", "mistralai/Mixtral-8x7B-Instruct-v0.1"),
+]
+
+
+class LLMRegistry:
+    def __init__(self, max_size: int = LLM_REGISTRY_MAX_SIZE):
+        self.max_size = max_size
+        self._clients = OrderedDict()
+        self._http_clients = {}
+        self._lock = threading.Lock()
+
+    def _http_clients_for(self, provider: str):
+        # One keep-alive pool per provider (sync and async), shared by every model client of
+        # that provider, so evicting a model client never throws away warm TLS connections.
+        with self._lock:
+            clients = self._http_clients.get(provider)
+            if clients is None:
+                limits = httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                )
+                clients = (httpx.Client(timeout=HTTP_TIMEOUT, limits=limits),
+                           httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=limits))
+                self._http_clients[provider] = clients
+            return clients
+
+    def _build(self, provider: str, model_name: str, settings: dict):
+        if provider == 'Groq':
+            http_client, http_async_client = self._http_clients_for(provider)
+            return ChatGroq(model=model_name, http_client=http_client,
+                            http_async_client=http_async_client, **settings)
+        elif provider == 'Gemini':
+            return ChatGoogleGenerativeAI(model=model_name, **settings)
+        elif provider == 'TogetherAI':
+            http_client, http_async_client = self._http_clients_for(provider)
+            return ChatTogether(model=model_name, http_client=http_client,
+                                http_async_client=http_async_client, **settings)
+        else:
+            raise ValueError(f"Unsupported provider: {provider}")
+
+    def get(self, provider: str, model_name: str, **settings):
+        key = (provider, model_name, tuple(sorted(settings.items())))
+        with self._lock:
+            llm = self._clients.get(key)
+            if llm is not None:
+                self._clients.move_to_end(key)
+                return llm
+
+        # Build outside the lock so a slow constructor does not block lookups of other models.
+        llm = self._build(provider, model_name, settings)
+
+        with self._lock:
+            existing = self._clients.get(key)
+            if existing is not None:
+                self._clients.move_to_end(key)
+                return existing
+            self._clients[key] = llm
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+            return llm
+
+    async def warm_up(self, models=None, prime_connections: bool = True):
+        for provider, model_name in models or DEFAULT_MODELS:
+            try:
+                self.get(provider, model_name)
+            except Exception as e:
+                print(f"Warm-up failed for {provider} ({model_name}): {e}")
+                continue
+
+            base_url = PROVIDER_BASE_URLS.get(provider)
+            if prime_connections and base_url:
+                try:
+                    # Any response will do; the point is to leave a TLS connection in the pool
+                    # the API actually uses, which is the async one.
+                    await self._http_clients_for(provider)[1].head(base_url)
+                except Exception as e:
+                    print(f"Connection warm-up failed for {provider}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"clients": len(self._clients), "max_size": self.max_size,
+                    "http_pools": len(self._http_clients)}
+
+    async def close(self):
+        with self._lock:
+            http_clients = list(self._http_clients.values())
+            self._http_clients.clear()
+            self._clients.clear()
+        for client, async_client in http_clients:
+            client.close()
+            await async_client.aclose()
+
+
+llm_registry = LLMRegistry()
@@ -0,0 +1,185 @@
+# mailer.py
+# Outbound mail for OTPs. Endpoints enqueue and return; sender threads hold authenticated
+# SMTP connections open between messages and send bursts over them back to back.
+# For local testing, point it at a stand-in server instead of Gmail:
+#   python -m aiosmtpd -n -l 127.0.0.1:1025 &
+#   SMTP_HOST=127.0.0.1 SMTP_PORT=1025 SMTP_USE_SSL=0 SMTP_USERNAME= uvicorn api:app
+import os
+import queue
+import smtplib
+import threading
+import time
+import traceback
+from email.message import EmailMessage
+
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "465"))
+SMTP_USE_SSL = os.environ.get("SMTP_USE_SSL", "1") == "1"
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "0") == "1"
+# An empty username skips login, as local stand-in servers expect
+SMTP_USERNAME = os.environ.get("SMTP_USERNAME", os.environ.get("EMAIL", ""))
+SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD", os.environ.get("PASSWORD", ""))
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", "20"))
+MAIL_FROM = os.environ.get("MAIL_FROM", os.environ.get("EMAIL", ""))
+MAIL_SENDERS = int(os.environ.get("MAIL_SENDERS", "2"))
+MAIL_QUEUE_SIZE = int(os.environ.get("MAIL_QUEUE_SIZE", "1000"))
+MAIL_BATCH_SIZE = int(os.environ.get("MAIL_BATCH_SIZE", "20"))
+# Close a connection nobody has used for this long; servers drop idle sessions anyway
+MAIL_IDLE_TIMEOUT = float(os.environ.get("MAIL_IDLE_TIMEOUT", "60"))
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", "5"))
+MAIL_BACKOFF_MAX = float(os.environ.get("MAIL_BACKOFF_MAX", "30"))
+
+
+class MailQueueFull(Exception):
+    pass
+
+
+class MailQueue:
+    """Bounded queue of outgoing messages drained by `senders` threads, each with its own connection."""
+
+    def __init__(self, senders: int = MAIL_SENDERS, max_size: int = MAIL_QUEUE_SIZE,
+                 batch_size: int = MAIL_BATCH_SIZE):
+        self.senders = senders
+        self.batch_size = batch_size
+        self.queue = queue.Queue(max_size)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.counters = {"enqueued": 0, "sent": 0, "failed": 0, "rejected": 0, "connects": 0, "reconnects": 0}
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            self.stopping.clear()
+            self.threads = [threading.Thread(target=self._run, name=f"mail-sender-{i}", daemon=True)
+                            for i in range(self.senders)]
+            for thread in self.threads:
+                thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Send what is already queued, for up to `timeout` seconds, then stop the senders."""
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+        self.stopping.set()
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+
+    def send(self, message: EmailMessage):
+        """Queue `message` for delivery and return at once."""
+        self.start()
+        try:
+            self.queue.put_nowait((message, 1))
+        except queue.Full:
+            self.counters["rejected"] += 1
+            raise MailQueueFull()
+        self.counters["enqueued"] += 1
+
+    def stats(self):
+        return {**self.counters, "queued": self.queue.qsize(), "senders": len(self.threads)}
+
+    def _connect(self):
+        if SMTP_USE_SSL:
+            smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_STARTTLS:
+                smtp.starttls()
+        if SMTP_USERNAME:
+            smtp.login(SMTP_USERNAME, SMTP_PASSWORD)
+        self.counters["connects"] += 1
+        return smtp
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _next_batch(self, smtp):
+        """Block for one message (or the idle timeout), then take whatever else is already waiting."""
+        try:
+            first = self.queue.get(timeout=MAIL_IDLE_TIMEOUT if smtp else None)
+        except queue.Empty:
+            return []
+        batch = [first]
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _retry_later(self, item):
+        message, attempt = item
+        if attempt >= MAIL_MAX_ATTEMPTS or self.stopping.is_set():
+            self.counters["failed"] += 1
+            print(f"⚠️ Giving up on mail to {message['To']} after {attempt} attempts")
+            return
+        try:
+            self.queue.put_nowait((message, attempt + 1))
+        except queue.Full:
+            self.counters["failed"] += 1
+
+    def _run(self):
+        smtp = None
+        failures = 0
+        while True:
+            batch = self._next_batch(smtp)
+            if not batch:
+                if smtp is not None:
+                    self._close(smtp)
+                    smtp = None
+                continue
+            stop = None in batch
+            pending = [item for item in batch if item is not None]
+
+            while pending:
+                if smtp is None:
+                    try:
+                        smtp = self._connect()
+                        failures = 0
+                    except (smtplib.SMTPException, OSError):
+                        failures += 1
+                        traceback.print_exc()
+                        for item in pending:
+                            self._retry_later(item)
+                        pending = []
+                        if not self.stopping.is_set():
+                            # Exponential backoff so an SMTP outage is not hammered by every sender
+                            self.stopping.wait(min(2 ** (failures - 1), MAIL_BACKOFF_MAX))
+                        break
+                message, attempt = pending[0]
+                try:
+                    smtp.send_message(message, from_addr=MAIL_FROM or None)
+                    self.counters["sent"] += 1
+                    pending.pop(0)
+                except smtplib.SMTPRecipientsRefused:
+                    # The address is bad, not the connection; retrying will not help
+                    self.counters["failed"] += 1
+                    pending.pop(0)
+                except (smtplib.SMTPException, OSError):
+                    # Usually the server closed a connection we kept open: reconnect and go on
+                    self._close(smtp)
+                    smtp = None
+                    self.counters["reconnects"] += 1
+                    pending.pop(0)
+                    if attempt >= MAIL_MAX_ATTEMPTS:
+                        self.counters["failed"] += 1
+                    else:
+                        pending.insert(0, (message, attempt + 1))
+
+            if stop:
+                if smtp is not None:
+                    self._close(smtp)
+                return
+
+
+mail_queue = MailQueue()
@@ -0,0 +1,131 @@
+# migrate_db.py
+from sqlalchemy import text, update
+from sqlalchemy.orm import Session
+from models import Base, Chat, ChatMessage, UploadedFile, DocumentChunk, SEARCH_VECTOR_SQL
+from database import engine
+from chat_store import split_messages
+from retrieval import chunk_document
+
+
+def add_missing_columns():
+    with engine.begin() as conn:
+        conn.execute(text(
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS history_version INTEGER NOT NULL DEFAULT 0"))
+        conn.execute(text(
+            "ALTER TABLE ingestion_jobs ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)"))
+        conn.execute(text(
+            "ALTER TABLE ingestion_jobs ADD COLUMN IF NOT EXISTS claimed_by VARCHAR"))
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gin"))
+        for table in ("chat_messages", "document_chunks"):
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS user_id INTEGER REFERENCES users(id)"))
+            # Stored generated column: adding it rewrites the table once
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                f"GENERATED ALWAYS AS ({SEARCH_VECTOR_SQL}) STORED"))
+
+
+def backfill_owner_ids(batch_size: int = 10000):
+    """Copy each chat's and file's owner onto its messages and chunks, in short batches."""
+    statements = {
+        "chat_messages": """
+            UPDATE chat_messages SET user_id = chats.user_id FROM chats
+            WHERE chats.id = chat_messages.chat_id AND chat_messages.id IN (
+                SELECT m.id FROM chat_messages m JOIN chats c ON c.id = m.chat_id
+                WHERE m.user_id IS NULL AND c.user_id IS NOT NULL LIMIT :batch_size)""",
+        "document_chunks": """
+            UPDATE document_chunks SET user_id = uploaded_files.user_id FROM uploaded_files
+            WHERE uploaded_files.id = document_chunks.file_id AND document_chunks.id IN (
+                SELECT d.id FROM document_chunks d JOIN uploaded_files f ON f.id = d.file_id
+                WHERE d.user_id IS NULL AND f.user_id IS NOT NULL LIMIT :batch_size)""",
+    }
+    for table, statement in statements.items():
+        updated = 0
+        while True:
+            with engine.begin() as conn:
+                rowcount = conn.execute(text(statement), {"batch_size": batch_size}).rowcount
+            if not rowcount:
+                break
+            updated += rowcount
+            print(f"  ... {updated} {table} rows")
+
+
+def create_missing_indexes():
+    """create_all only builds indexes together with new tables, so add the ones existing tables lack."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def migrate_chat_messages(batch_size: int = 500):
+    """Split legacy Chat.messages blobs into chat_messages rows, one chat at a time.
+
+    A chat that was appended to before its blob was migrated already has rows; the blob holds
+    its older turns, so those rows are moved up to make room for it at the start.
+    """
+    migrated = 0
+    with Session(engine) as db:
+        chat_ids = [cid for (cid,) in db.query(Chat.id)
+                    .filter(Chat.messages.isnot(None), Chat.messages != "")
+                    .order_by(Chat.id)]
+
+        for chat_id in chat_ids:
+            chat = db.get(Chat, chat_id, with_for_update=True)
+            legacy = split_messages(chat.messages)
+            # Through negative values, so no row collides with another on (chat_id, seq) midway
+            shifted = update(ChatMessage).where(ChatMessage.chat_id == chat.id) \
+                .execution_options(synchronize_session=False)
+            db.execute(shifted.values(seq=-ChatMessage.seq))
+            db.execute(shifted.values(seq=-ChatMessage.seq + len(legacy)))
+            for seq, msg in enumerate(legacy, start=1):
+                db.add(ChatMessage(chat_id=chat.id, user_id=chat.user_id, seq=seq, role=msg["role"],
+                                   content=msg["content"], created_at=chat.timestamp))
+            # Cleared in the same transaction as the inserts, so an interrupted run can simply be re-run.
+            chat.messages = None
+            migrated += 1
+            if migrated % batch_size == 0:
+                db.commit()
+                print(f"  ... {migrated}/{len(chat_ids)} chats")
+        db.commit()
+    return migrated
+
+
+def chunk_uploaded_files(batch_size: int = 100):
+    """Build retrieval chunks for uploads stored before documents were chunked at ingest."""
+    chunked = 0
+    with Session(engine) as db:
+        already_chunked = db.query(DocumentChunk.file_id).distinct()
+        file_ids = [fid for (fid,) in db.query(UploadedFile.id)
+                    .filter(UploadedFile.id.notin_(already_chunked))
+                    .order_by(UploadedFile.id)]
+
+        for file_id in file_ids:
+            uploaded_file = db.get(UploadedFile, file_id)
+            if not uploaded_file.extracted_text:
+                continue
+            chunks = chunk_document(uploaded_file.file_type, uploaded_file.extracted_text)
+            for seq, (page, content) in enumerate(chunks, start=1):
+                db.add(DocumentChunk(file_id=file_id, user_id=uploaded_file.user_id, seq=seq, page=page,
+                                     content=content))
+            chunked += 1
+            if chunked % batch_size == 0:
+                db.commit()
+                print(f"  ... {chunked}/{len(file_ids)} files")
+        db.commit()
+    return chunked
+
+
+if __name__ == "__main__":
+    print("📦 Creating missing tables...")
+    Base.metadata.create_all(bind=engine)
+    print("🧱 Adding missing columns...")
+    add_missing_columns()
+    print("👤 Backfilling owners of messages and document chunks...")
+    backfill_owner_ids()
+    print("🗂️ Creating missing indexes...")
+    create_missing_indexes()
+    print("🔀 Splitting chat message blobs into chat_messages...")
+    count = migrate_chat_messages()
+    print("✂️ Chunking uploaded documents for retrieval...")
+    files = chunk_uploaded_files()
+    print(f"✅ Done: {count} chats migrated, {files} documents chunked.")
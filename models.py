@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, JSON
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy import Column, Integer, Float, String, Text, ForeignKey, DateTime, JSON, UniqueConstraint, Index, LargeBinary, \
+    Computed, DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, declarative_base, deferred
 from datetime import datetime, timedelta
 
 Base = declarative_base()
@@ -11,6 +13,8 @@ class User(Base):
     username = Column(String, unique=True)
     email = Column(String, unique=True)
     password = Column(String)
+    # Bumped on every chat create/append/rename/delete; drives the /history ETag.
+    history_version = Column(Integer, nullable=False, default=0, server_default="0")
 
     chats = relationship("Chat", back_populates="user")
     uploaded_files = relationship("UploadedFile", back_populates="user")
@@ -26,6 +30,42 @@ class Chat(Base):
 
     user = relationship("User", back_populates="chats")
     uploaded_files = relationship("UploadedFile", back_populates="chat") 
+    chat_messages = relationship("ChatMessage", back_populates="chat", order_by="ChatMessage.seq",
+                                 cascade="all, delete-orphan", passive_deletes=True)
+
+# Search config shared by the stored vectors and the queries in search.py
+SEARCH_CONFIG = "english"
+SEARCH_VECTOR_SQL = f"to_tsvector('{SEARCH_CONFIG}', coalesce(content, ''))"
+
+class ChatMessage(Base):
+    __tablename__ = "chat_messages"
+    __table_args__ = (UniqueConstraint("chat_id", "seq", name="uq_chat_messages_chat_id_seq"),)
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
+    # Copy of the chat's owner so a search can be scoped to one user inside the GIN index
+    user_id = Column(Integer, ForeignKey("users.id"))
+    seq = Column(Integer, nullable=False)
+    role = Column(String, nullable=False)
+    content = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR_SQL, persisted=True)))
+
+    chat = relationship("Chat", back_populates="chat_messages")
+
+# Rolling summary of a chat's oldest turns (context.py). It stands in for the first
+# `covered_count` messages as long as they still hash to `covered_hash`.
+class ChatSummary(Base):
+    __tablename__ = "chat_summaries"
+
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), primary_key=True)
+    summary = Column(Text, nullable=False)
+    covered_count = Column(Integer, nullable=False)
+    covered_hash = Column(String(64), nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Serves the keyset-paginated /history listing: newest chats of one user first.
+Index("ix_chats_user_id_timestamp", Chat.user_id, Chat.timestamp.desc(), Chat.id.desc())
 
 class UploadedFile(Base):
     __tablename__ = "uploaded_files"
@@ -41,6 +81,33 @@ class UploadedFile(Base):
 
     user = relationship("User", back_populates="uploaded_files")  
     chat = relationship("Chat", back_populates="uploaded_files") 
+    chunks = relationship("DocumentChunk", back_populates="file", order_by="DocumentChunk.seq",
+                          cascade="all, delete-orphan", passive_deletes=True)
+
+Index("ix_uploaded_files_chat_id", UploadedFile.chat_id)
+
+# Retrieval units of an upload's extracted text (retrieval.py); `page` is 1-based, None for images.
+class DocumentChunk(Base):
+    __tablename__ = "document_chunks"
+    __table_args__ = (UniqueConstraint("file_id", "seq", name="uq_document_chunks_file_id_seq"),)
+
+    id = Column(Integer, primary_key=True)
+    file_id = Column(Integer, ForeignKey("uploaded_files.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    seq = Column(Integer, nullable=False)
+    page = Column(Integer)
+    content = Column(Text, nullable=False)
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR_SQL, persisted=True)))
+
+    file = relationship("UploadedFile", back_populates="chunks")
+
+# Full-text search over one user's messages and documents (/history/search). btree_gin lets
+# user_id sit inside the GIN index, so a search never visits other users' rows.
+Index("ix_chat_messages_user_search", ChatMessage.user_id, ChatMessage.__table__.c.search_vector,
+      postgresql_using="gin")
+Index("ix_document_chunks_user_search", DocumentChunk.user_id, DocumentChunk.__table__.c.search_vector,
+      postgresql_using="gin")
+event.listen(Base.metadata, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS btree_gin"))
 
 
 class OTP(Base):
@@ -51,3 +118,55 @@ class OTP(Base):
     expires_at=Column(DateTime, default=lambda: datetime.utcnow() + timedelta(minutes=5))
     password = Column(String)
 
+
+class IngestionJob(Base):
+    __tablename__ = "ingestion_jobs"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    file_name = Column(String)
+    file_type = Column(String)
+    payload = Column(LargeBinary)  # cleared once the job has finished
+    status = Column(String, nullable=False, default="queued")  # queued, running, done, failed
+    pages_done = Column(Integer, nullable=False, default=0)
+    pages_total = Column(Integer)
+    error = Column(Text)
+    content_hash = Column(String(64))  # SHA-256 of payload, key into extraction_cache
+    # Chat the upload was attached to at enqueue time; otherwise the chat created for it when done
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="SET NULL"))
+    file_id = Column(Integer, ForeignKey("uploaded_files.id", ondelete="SET NULL"))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)  # doubles as the worker heartbeat
+    finished_at = Column(DateTime)
+    claimed_by = Column(String)  # worker running the job; only it may finish it
+
+# Workers claim the oldest queued job; keeps that scan off the finished backlog.
+Index("ix_ingestion_jobs_status_id", IngestionJob.status, IngestionJob.id)
+
+
+# Extracted text keyed by content hash: whole uploads (kind "pdf"/"image") or rendered pages ("page").
+class ExtractionCache(Base):
+    __tablename__ = "extraction_cache"
+
+    kind = Column(String, primary_key=True)
+    content_hash = Column(String(64), primary_key=True)
+    extracted_text = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Shared tier of the LLM response cache (cache.py); the key is a hash of the full request.
+class LLMResponseCache(Base):
+    __tablename__ = "llm_response_cache"
+
+    cache_key = Column(String(64), primary_key=True)
+    response = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+# Per-user request token buckets (ratelimit.py) shared by all API workers; `tokens` as of `updated_at`.
+class RateLimitBucket(Base):
+    __tablename__ = "rate_limit_buckets"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
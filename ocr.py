@@ -0,0 +1,143 @@
+import hashlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fitz
+import pytesseract
+from PIL import Image
+
+from metrics import metrics
+
+TESSERACT_CMD = os.environ.get("TESSERACT_CMD", r"C:\Program Files\Tesseract-OCR\tesseract.exe")
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", str(os.cpu_count() or 2)))
+
+pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+
+_executor = None
+
+# Observed in the parent process: pool workers each have a registry nobody scrapes
+OCR_PAGE_SECONDS = metrics.histogram("ocr_page_seconds", "Tesseract time per page or image, rendering included",
+                                     ("source",))
+OCR_PAGES = metrics.counter("ocr_pages_total", "Document pages extracted, by where their text came from",
+                            ("source",))
+
+
+def _init_worker():
+    # Spawned workers (Windows, macOS) do not inherit module state set after import
+    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+
+
+def _text_layer(pdf_bytes: bytes):
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    return [page.get_text().strip() for page in doc]
+
+
+def _ocr_pages(pdf_bytes: bytes, page_numbers: list):
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    results = []
+    for page_number in page_numbers:
+        started = time.perf_counter()
+        pix = doc[page_number].get_pixmap()
+        img = Image.open(io.BytesIO(pix.tobytes()))
+        text = pytesseract.image_to_string(img)
+        results.append((page_number, text, time.perf_counter() - started))
+    return results
+
+
+def _hash_pages(pdf_bytes: bytes, page_numbers: list):
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    return [(page_number, hashlib.sha256(doc[page_number].get_pixmap().samples).hexdigest())
+            for page_number in page_numbers]
+
+
+def _ocr_image(image_bytes: bytes):
+    return pytesseract.image_to_string(Image.open(io.BytesIO(image_bytes)))
+
+
+def get_ocr_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=_init_worker)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def split_for_workers(page_numbers: list, workers: int):
+    """Deal pages round-robin into at most 2 batches per worker.
+
+    Each batch ships the whole PDF to a worker once, so batches are kept few; interleaving
+    spreads heavy and light stretches of a document evenly across them.
+    """
+    batch_count = min(len(page_numbers), workers * 2)
+    return [page_numbers[i::batch_count] for i in range(batch_count)]
+
+
+def content_hash(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+def extract_pdf_pages(pdf_bytes: bytes, on_progress=None, page_cache=None):
+    """Return the text of every page, in page order.
+
+    Pages with a text layer are read directly; only empty pages are rendered and OCR'd,
+    fanned out over the process pool. `on_progress(pages_done, pages_total)` is called
+    after the text pass and after every finished OCR batch.
+
+    With a `page_cache` (get_many(hashes) -> {hash: text}, put_many({hash: text})), empty
+    pages are first rendered and hashed, and only pages whose pixmap has never been seen
+    are OCR'd. Misses are rendered a second time for OCR, which is cheap next to tesseract.
+    """
+    pages = _text_layer(pdf_bytes)
+    missing = [page_number for page_number, text in enumerate(pages) if not text]
+    pages_done = len(pages) - len(missing)
+    OCR_PAGES.labels("text_layer").inc(pages_done)
+    if on_progress:
+        on_progress(pages_done, len(pages))
+    if not missing:
+        return pages
+
+    executor = get_ocr_executor()
+    page_hashes = {}
+    if page_cache is not None:
+        hash_batches = split_for_workers(missing, OCR_WORKERS)
+        for batch in executor.map(_hash_pages, [pdf_bytes] * len(hash_batches), hash_batches):
+            page_hashes.update(batch)
+        cached = page_cache.get_many(set(page_hashes.values()))
+        for page_number in missing:
+            if page_hashes[page_number] in cached:
+                pages[page_number] = cached[page_hashes[page_number]]
+        missing = [page_number for page_number in missing if page_hashes[page_number] not in cached]
+        OCR_PAGES.labels("cache").inc(len(pages) - len(missing) - pages_done)
+        pages_done = len(pages) - len(missing)
+        if on_progress:
+            on_progress(pages_done, len(pages))
+        if not missing:
+            return pages
+
+    futures = [executor.submit(_ocr_pages, pdf_bytes, batch)
+               for batch in split_for_workers(missing, OCR_WORKERS)]
+    for future in as_completed(futures):
+        batch = future.result()
+        for page_number, text, seconds in batch:
+            pages[page_number] = text
+            OCR_PAGE_SECONDS.labels("pdf").observe(seconds)
+        OCR_PAGES.labels("ocr").inc(len(batch))
+        if page_cache is not None:
+            page_cache.put_many({page_hashes[page_number]: text for page_number, text, _ in batch})
+        pages_done += len(batch)
+        if on_progress:
+            on_progress(pages_done, len(pages))
+    return pages
+
+
+def extract_image_text(image_bytes: bytes):
+    with OCR_PAGE_SECONDS.labels("image").time():
+        return _ocr_image(image_bytes)
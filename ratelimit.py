@@ -0,0 +1,215 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import select, func, literal, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import TTLCache
+from deadline import capped
+from database import AsyncSessionLocal
+from models import RateLimitBucket
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+# Each user's bucket refills at RATE_LIMIT_RATE tokens a second up to RATE_LIMIT_BURST
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", "0.5"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "20"))
+# Tokens a request costs, roughly the upstream calls it makes; fusion fans out to every candidate and a merge
+RATE_LIMIT_WEIGHTS = {
+    "Groq": float(os.environ.get("RATE_LIMIT_GROQ_WEIGHT", "1")),
+    "Gemini": float(os.environ.get("RATE_LIMIT_GEMINI_WEIGHT", "1")),
+    "TogetherAI": float(os.environ.get("RATE_LIMIT_TOGETHER_WEIGHT", "1")),
+    "White-Fusion": float(os.environ.get("RATE_LIMIT_FUSION_WEIGHT", "4")),
+}
+# Requests one user may have running at once in this worker, and waiting behind those
+USER_MAX_CONCURRENT = int(os.environ.get("USER_MAX_CONCURRENT", "2"))
+USER_MAX_QUEUED = int(os.environ.get("USER_MAX_QUEUED", "4"))
+USER_QUEUE_TIMEOUT = float(os.environ.get("USER_QUEUE_TIMEOUT", "15"))
+# Keeps buckets in Postgres so every worker charges the same one; costs a query per request.
+RATE_LIMIT_SHARED = os.environ.get("RATE_LIMIT_SHARED", "0") == "1"
+RATE_LIMIT_MAX_USERS = int(os.environ.get("RATE_LIMIT_MAX_USERS", "100000"))
+
+
+class RateLimited(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+def request_weight(provider: str):
+    return RATE_LIMIT_WEIGHTS.get(provider, 1.0)
+
+
+class Admission:
+    """A held concurrency slot; release it when the request, or its stream, is finished."""
+
+    def __init__(self, limiter, user_id):
+        self.limiter = limiter
+        self.user_id = user_id
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            if self.limiter is not None:
+                self.limiter._release(self.user_id)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class UserGate:
+    __slots__ = ("in_flight", "waiters")
+
+    def __init__(self):
+        self.in_flight = 0
+        self.waiters = deque()
+
+
+class RateLimiter:
+    """Per-user admission for the LLM endpoints: a weighted token bucket, then a concurrency cap.
+
+    Requests over the cap wait in a short per-user queue; a full queue, a queue timeout or an
+    empty bucket all raise RateLimited with the seconds after which a retry can succeed.
+    Concurrency is always tracked per worker; buckets are too unless RATE_LIMIT_SHARED is on.
+    """
+
+    def __init__(self, rate: float = RATE_LIMIT_RATE, burst: float = RATE_LIMIT_BURST,
+                 max_concurrent: int = USER_MAX_CONCURRENT, max_queued: int = USER_MAX_QUEUED,
+                 queue_timeout: float = USER_QUEUE_TIMEOUT, shared: bool = RATE_LIMIT_SHARED):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.shared = shared
+        # A bucket untouched for burst / rate seconds is full again, the same as no entry at all
+        self.buckets = TTLCache(RATE_LIMIT_MAX_USERS, burst / rate)
+        self.gates = {}
+        self.counters = {"admitted": 0, "queued": 0, "rejected_rate": 0, "rejected_queue_full": 0,
+                         "rejected_queue_timeout": 0, "shared_errors": 0}
+        self.wait_seconds = 0.0
+
+    async def admit(self, user_id: int, weight: float = 1.0):
+        """Charge `weight` tokens to the user and take a concurrency slot; returns an Admission."""
+        if not RATE_LIMIT_ENABLED:
+            return Admission(None, user_id)
+        cost = min(weight, self.burst)
+        if self.shared:
+            retry_after = await self._take_shared(user_id, cost)
+        else:
+            retry_after = self._take_local(user_id, cost)
+        if retry_after:
+            self.counters["rejected_rate"] += 1
+            raise RateLimited("rate", retry_after)
+        await self._acquire(user_id)
+        self.counters["admitted"] += 1
+        return Admission(self, user_id)
+
+    def _take_local(self, user_id: int, cost: float):
+        """Take `cost` tokens and return 0, or return the seconds until there will be enough."""
+        now = time.monotonic()
+        state = self.buckets.get(user_id)
+        tokens = self.burst if state is None else min(self.burst, state[0] + (now - state[1]) * self.rate)
+        if tokens < cost:
+            return (cost - tokens) / self.rate
+        self.buckets.set(user_id, (tokens - cost, now))
+        return 0
+
+    async def _take_shared(self, user_id: int, cost: float):
+        now = datetime.utcnow()
+        # The refill, the check and the charge happen in one statement, so concurrent workers can't overdraw
+        refilled = func.least(self.burst, RateLimitBucket.tokens + func.extract(
+            "epoch", literal(now, DateTime) - RateLimitBucket.updated_at) * self.rate)
+        try:
+            async with AsyncSessionLocal() as db:
+                charged = await db.scalar(
+                    insert(RateLimitBucket)
+                    .values(user_id=user_id, tokens=self.burst - cost, updated_at=now)
+                    .on_conflict_do_update(index_elements=[RateLimitBucket.user_id],
+                                           set_={"tokens": refilled - cost, "updated_at": now},
+                                           where=refilled >= cost)
+                    .returning(RateLimitBucket.tokens))
+                if charged is None:
+                    tokens = await db.scalar(select(refilled).where(RateLimitBucket.user_id == user_id))
+                await db.commit()
+        except Exception as e:
+            # Fall back to this worker's buckets rather than failing or waving everything through
+            self.counters["shared_errors"] += 1
+            print(f"Shared rate limit bucket failed: {e}")
+            return self._take_local(user_id, cost)
+        if charged is not None:
+            return 0
+        return max((cost - (tokens or 0.0)) / self.rate, 0.001)
+
+    async def _acquire(self, user_id: int):
+        gate = self.gates.get(user_id)
+        if gate is None:
+            gate = self.gates[user_id] = UserGate()
+        if gate.in_flight < self.max_concurrent and not gate.waiters:
+            gate.in_flight += 1
+            return
+        if len(gate.waiters) >= self.max_queued:
+            self.counters["rejected_queue_full"] += 1
+            raise RateLimited("queue_full", 1)
+
+        self.counters["queued"] += 1
+        waiter = asyncio.get_running_loop().create_future()
+        gate.waiters.append(waiter)
+        started = time.monotonic()
+        try:
+            # Never queue past the request's own deadline
+            await asyncio.wait_for(asyncio.shield(waiter), capped(self.queue_timeout))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self._release(user_id)
+            else:
+                waiter.cancel()
+                gate.waiters.remove(waiter)
+                self._drop_idle(user_id, gate)
+            if isinstance(e, asyncio.TimeoutError):
+                self.counters["rejected_queue_timeout"] += 1
+                raise RateLimited("queue_timeout", 1)
+            raise
+        finally:
+            self.wait_seconds += time.monotonic() - started
+
+    def _release(self, user_id: int):
+        gate = self.gates.get(user_id)
+        if gate is None:
+            return
+        while gate.waiters:
+            waiter = gate.waiters.popleft()
+            if not waiter.done():
+                # Hand the slot straight to the oldest waiter; in_flight stays the same
+                waiter.set_result(None)
+                return
+        gate.in_flight -= 1
+        self._drop_idle(user_id, gate)
+
+    def _drop_idle(self, user_id: int, gate: UserGate):
+        if gate.in_flight <= 0 and not gate.waiters:
+            self.gates.pop(user_id, None)
+
+    def stats(self):
+        return {**self.counters, "enabled": RATE_LIMIT_ENABLED, "shared": self.shared,
+                "active_users": len(self.gates),
+                "in_flight": sum(gate.in_flight for gate in self.gates.values()),
+                "waiting": sum(len(gate.waiters) for gate in self.gates.values()),
+                "avg_wait_ms": round(self.wait_seconds / self.counters["queued"] * 1000, 1)
+                if self.counters["queued"] else 0.0}
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import math
+import os
+import re
+from array import array
+from collections import Counter, namedtuple
+from operator import itemgetter
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+from context import estimate_tokens
+from models import DocumentChunk, UploadedFile
+
+CHUNK_CHARS = 1000
+CHUNK_OVERLAP_CHARS = 150
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "6"))
+# Prompt tokens spent on document excerpts per turn, however large the documents are
+RETRIEVAL_TOKENS = int(os.environ.get("RETRIEVAL_TOKENS", "1500"))
+RETRIEVAL_INDEX_CACHE_SIZE = int(os.environ.get("RETRIEVAL_INDEX_CACHE_SIZE", "64"))
+RETRIEVAL_INDEX_TTL = float(os.environ.get("RETRIEVAL_INDEX_TTL", "1800"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i if in into is it its of on or so such that the "
+    "their then there these they this to was were what when where which who why will with you your".split())
+
+Chunk = namedtuple("Chunk", "id file_name page content")
+
+
+def split_text(text: str, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP_CHARS):
+    """Cut `text` into windows of about `size` characters, ending on whitespace where possible."""
+    text = text.strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = max(text.rfind(" ", start + size // 2, end), text.rfind("\n", start + size // 2, end))
+            if cut > 0:
+                end = cut
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        next_start = max(end - overlap, start + 1)
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return [chunk for chunk in chunks if chunk]
+
+
+def chunk_document(file_type: str, extracted_text):
+    """Return (page, content) pairs for an upload's extracted text, in document order."""
+    if file_type == "pdf":
+        return [(page_number, chunk)
+                for page_number, page_text in enumerate(extracted_text["pages"], start=1)
+                for chunk in split_text(page_text)]
+    return [(None, chunk) for chunk in split_text(extracted_text or "")]
+
+
+def tokenize(text: str):
+    return [token for token in TOKEN_RE.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+class BM25Index:
+    """Inverted index over one chat's chunks.
+
+    Postings are kept as parallel arrays of chunk positions and term frequencies, which keeps
+    an index over a 1,000-page corpus to a few megabytes.
+    """
+
+    def __init__(self, chunks: list):
+        self.chunks = chunks
+        self.postings = {}
+        self.lengths = array("I")
+        for position, chunk in enumerate(chunks):
+            counts = Counter(tokenize(chunk.content))
+            self.lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                entry = self.postings.get(term)
+                if entry is None:
+                    entry = self.postings[term] = (array("I"), array("H"))
+                entry[0].append(position)
+                entry[1].append(min(tf, 65535))
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if chunks else 0.0
+
+    def search(self, query: str, k: int):
+        """Return the top `k` (chunk, score) pairs for `query`, best first."""
+        if not self.chunks:
+            return []
+        n = len(self.chunks)
+        lengths = self.lengths
+        base = BM25_K1 * (1 - BM25_B)
+        per_token = BM25_K1 * BM25_B / (self.avg_length or 1.0)
+        scores = {}
+        for term in set(tokenize(query)):
+            entry = self.postings.get(term)
+            if entry is None:
+                continue
+            positions, tfs = entry
+            idf = math.log(1 + (n - len(positions) + 0.5) / (len(positions) + 0.5))
+            for position, tf in zip(positions, tfs):
+                score = idf * tf * (BM25_K1 + 1) / (tf + base + per_token * lengths[position])
+                scores[position] = scores.get(position, 0.0) + score
+        best = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+        return [(self.chunks[position], score) for position, score in best]
+
+
+# chat id -> (ids of the chat's files, index); chunks never change, so the file set is the version
+index_cache = TTLCache(RETRIEVAL_INDEX_CACHE_SIZE, RETRIEVAL_INDEX_TTL)
+
+
+async def chat_index(db: AsyncSession, chat_id: int):
+    file_ids = tuple((await db.scalars(
+        select(UploadedFile.id).where(UploadedFile.chat_id == chat_id).order_by(UploadedFile.id))).all())
+    if not file_ids:
+        return None
+    cached = index_cache.get(chat_id)
+    if cached is not None and cached[0] == file_ids:
+        return cached[1]
+
+    rows = (await db.execute(
+        select(DocumentChunk.id, UploadedFile.file_name, DocumentChunk.page, DocumentChunk.content)
+        .join(UploadedFile, UploadedFile.id == DocumentChunk.file_id)
+        .where(DocumentChunk.file_id.in_(file_ids))
+        .order_by(DocumentChunk.file_id, DocumentChunk.seq)
+    )).all()
+    index = await asyncio.to_thread(BM25Index, [Chunk(*row) for row in rows])
+    index_cache.set(chat_id, (file_ids, index))
+    return index
+
+
+async def retrieve(db: AsyncSession, chat_id: int, query: str, k: int = RETRIEVAL_TOP_K,
+                   token_budget: int = RETRIEVAL_TOKENS):
+    """Return the chunks of the chat's documents most relevant to `query` that fit in `token_budget`."""
+    index = await chat_index(db, chat_id)
+    if index is None:
+        return []
+    selected, used = [], 0
+    for chunk, _ in index.search(query, k):
+        cost = estimate_tokens(chunk.content)
+        if used + cost > token_budget:
+            continue
+        selected.append(chunk)
+        used += cost
+    return selected
+
+
+def format_excerpts(chunks: list):
+    parts = []
+    for chunk in chunks:
+        source = f"{chunk.file_name}, page {chunk.page}" if chunk.page else chunk.file_name
+        parts.append(f"[{source}]\n{chunk.content}")
+    return "Relevant excerpts from the documents uploaded to this chat:\n\n" + "\n\n".join(parts)
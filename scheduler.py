@@ -0,0 +1,174 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from itertools import count
+
+from metrics import metrics
+
+# Upper bound on in-flight calls per provider for this worker; excess calls wait on the event loop
+# instead of each parking a threadpool thread.
+PROVIDER_CONCURRENCY = {
+    "Groq": int(os.environ.get("GROQ_CONCURRENCY", "32")),
+    "Gemini": int(os.environ.get("GEMINI_CONCURRENCY", "32")),
+    "TogetherAI": int(os.environ.get("TOGETHER_CONCURRENCY", "32")),
+}
+DEFAULT_PROVIDER_CONCURRENCY = 32
+
+# Lower runs first: a user's own turn (and the fusion merge it waits on), then fusion fan-out
+# calls, then work nobody is waiting on, such as chat titles.
+INTERACTIVE = "interactive"
+FUSION = "fusion"
+BACKGROUND = "background"
+LANE_PRIORITY = {INTERACTIVE: 0, FUSION: 1, BACKGROUND: 2}
+# A waiting call gains one priority level per this many seconds, so a busy lane can't starve the others
+LANE_AGING_SECONDS = float(os.environ.get("LANE_AGING_SECONDS", "5"))
+# Share of each provider's slots background calls may never take, kept free for users' turns
+BACKGROUND_RESERVED_SHARE = float(os.environ.get("BACKGROUND_RESERVED_SHARE", "0.25"))
+
+SLOT_WAIT_SECONDS = metrics.histogram("scheduler_wait_seconds", "Time provider calls waited for a slot",
+                                      ("provider", "lane"))
+
+
+class Waiter:
+    __slots__ = ("lane", "priority", "enqueued_at", "seq", "future")
+
+    def __init__(self, lane: str, seq: int):
+        self.lane = lane
+        self.priority = LANE_PRIORITY[lane]
+        self.enqueued_at = time.monotonic()
+        self.seq = seq
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class LaneStats:
+    __slots__ = ("calls", "queued", "wait_seconds", "max_wait")
+
+    def __init__(self):
+        self.calls = 0
+        self.queued = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+
+    def record(self, waited: float):
+        self.calls += 1
+        if waited > 0:
+            self.queued += 1
+            self.wait_seconds += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def as_dict(self):
+        return {"calls": self.calls, "queued": self.queued,
+                "avg_wait_ms": round(self.wait_seconds / self.queued * 1000, 1) if self.queued else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 1)}
+
+
+class ProviderQueue:
+    """Slots for one provider, handed to waiters by lane priority with aging."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # Background calls stop at this many in flight, however long they have waited
+        self.background_limit = max(capacity - max(1, round(capacity * BACKGROUND_RESERVED_SHARE)), 1) \
+            if capacity > 1 else capacity
+        self.in_flight = 0
+        self.background_in_flight = 0
+        self.waiters = []
+
+    def can_start(self, lane: str):
+        if self.in_flight >= self.capacity:
+            return False
+        return lane != BACKGROUND or self.background_in_flight < self.background_limit
+
+    def start(self, lane: str):
+        self.in_flight += 1
+        if lane == BACKGROUND:
+            self.background_in_flight += 1
+
+    def finish(self, lane: str):
+        self.in_flight -= 1
+        if lane == BACKGROUND:
+            self.background_in_flight -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        """Start the best eligible waiters while slots are free."""
+        while self.waiters and self.in_flight < self.capacity:
+            # A cancelled call's future is done before its own cleanup runs; never hand it a slot
+            self.waiters = [waiter for waiter in self.waiters if not waiter.future.done()]
+            now = time.monotonic()
+            best = None
+            best_key = None
+            for waiter in self.waiters:
+                if not self.can_start(waiter.lane):
+                    continue
+                key = (waiter.priority - (now - waiter.enqueued_at) / LANE_AGING_SECONDS, waiter.seq)
+                if best_key is None or key < best_key:
+                    best, best_key = waiter, key
+            if best is None:
+                return
+            self.waiters.remove(best)
+            self.start(best.lane)
+            best.future.set_result(None)
+
+
+class Scheduler:
+    """Admits every outbound provider call through per-provider queues with priority lanes."""
+
+    def __init__(self, concurrency: dict = None):
+        self.concurrency = concurrency or PROVIDER_CONCURRENCY
+        self.queues = {}
+        self.lanes = {lane: LaneStats() for lane in LANE_PRIORITY}
+        self.seq = count()
+
+    def queue_for(self, provider: str):
+        queue = self.queues.get(provider)
+        if queue is None:
+            queue = self.queues[provider] = ProviderQueue(
+                self.concurrency.get(provider, DEFAULT_PROVIDER_CONCURRENCY))
+        return queue
+
+    @asynccontextmanager
+    async def slot(self, provider: str, lane: str = INTERACTIVE):
+        queue = self.queue_for(provider)
+        if not queue.waiters and queue.can_start(lane):
+            queue.start(lane)
+            self.lanes[lane].record(0.0)
+            SLOT_WAIT_SECONDS.labels(provider, lane).observe(0.0)
+        else:
+            waiter = Waiter(lane, next(self.seq))
+            queue.waiters.append(waiter)
+            # Calls queued ahead may all be ones that can't run now, e.g. background past its limit
+            queue.dispatch()
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # Given a slot just as we were cancelled; give it back
+                    queue.finish(lane)
+                elif waiter in queue.waiters:
+                    # dispatch may already have dropped it
+                    queue.waiters.remove(waiter)
+                raise
+            waited = time.monotonic() - waiter.enqueued_at
+            self.lanes[lane].record(waited)
+            SLOT_WAIT_SECONDS.labels(provider, lane).observe(waited)
+        try:
+            yield
+        finally:
+            queue.finish(lane)
+
+    def stats(self):
+        return {
+            "lanes": {lane: {**stats.as_dict(),
+                             "waiting": sum(1 for queue in self.queues.values()
+                                            for waiter in queue.waiters if waiter.lane == lane)}
+                      for lane, stats in self.lanes.items()},
+            "providers": {provider: {"capacity": queue.capacity, "in_flight": queue.in_flight,
+                                     "background_in_flight": queue.background_in_flight,
+                                     "waiting": len(queue.waiters)}
+                          for provider, queue in self.queues.items()},
+        }
+
+
+scheduler = Scheduler()
@@ -0,0 +1,77 @@
+import os
+
+from sqlalchemy import select, func, literal, union_all, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Chat, ChatMessage, DocumentChunk, UploadedFile, SEARCH_CONFIG
+
+HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxWords=30, MinWords=12, MaxFragments=2"
+# Ranking cost grows with the number of hits, which for a common word can be most of a heavy
+# user's messages; at most this many message hits, and as many document hits, are ranked. The cap
+# takes whichever hits the GIN scan returns first: ordering them by id would make the planner walk
+# the primary key through every other user's messages instead.
+SEARCH_MAX_HITS = int(os.environ.get("SEARCH_MAX_HITS", "2000"))
+
+
+async def search_chats(db: AsyncSession, user_id: int, q: str, limit: int, offset: int):
+    """Rank the user's chats by how well their messages and documents match the search `q`.
+
+    Matching runs entirely on the (user_id, search_vector) GIN indexes. Each chat appears once,
+    scored by the sum of its matches' ranks (over at most SEARCH_MAX_HITS of each kind),
+    with a highlighted snippet of its best match.
+    Snippets are only built for the returned page, since ts_headline re-parses the text.
+    """
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+
+    message_hits = (
+        select(ChatMessage.chat_id.label("chat_id"),
+               func.ts_rank_cd(ChatMessage.search_vector, tsquery).label("rank"),
+               ChatMessage.id.label("message_id"),
+               literal(None, Integer).label("chunk_id"))
+        .where(ChatMessage.user_id == user_id, ChatMessage.search_vector.op("@@")(tsquery))
+        .limit(SEARCH_MAX_HITS)
+    )
+    chunk_hits = (
+        select(UploadedFile.chat_id.label("chat_id"),
+               func.ts_rank_cd(DocumentChunk.search_vector, tsquery).label("rank"),
+               literal(None, Integer).label("message_id"),
+               DocumentChunk.id.label("chunk_id"))
+        .join(UploadedFile, UploadedFile.id == DocumentChunk.file_id)
+        .where(DocumentChunk.user_id == user_id, DocumentChunk.search_vector.op("@@")(tsquery),
+               UploadedFile.chat_id.isnot(None))
+        .limit(SEARCH_MAX_HITS)
+    )
+    hits = union_all(message_hits, chunk_hits).subquery()
+
+    ranked = select(
+        hits.c.chat_id, hits.c.message_id, hits.c.chunk_id,
+        func.sum(hits.c.rank).over(partition_by=hits.c.chat_id).label("score"),
+        func.count().over(partition_by=hits.c.chat_id).label("matches"),
+        func.row_number().over(partition_by=hits.c.chat_id, order_by=hits.c.rank.desc()).label("position"),
+    ).subquery()
+
+    page = (
+        select(ranked.c.chat_id, ranked.c.message_id, ranked.c.chunk_id, ranked.c.score, ranked.c.matches,
+               Chat.title, Chat.timestamp)
+        .join(Chat, Chat.id == ranked.c.chat_id)
+        .where(ranked.c.position == 1)
+        .order_by(ranked.c.score.desc(), ranked.c.chat_id.desc())
+        .limit(limit + 1)
+        .offset(offset)
+    ).subquery()
+
+    rows = (await db.execute(
+        select(page, func.ts_headline(SEARCH_CONFIG, func.coalesce(ChatMessage.content, DocumentChunk.content),
+                                      tsquery, HEADLINE_OPTIONS).label("snippet"))
+        .outerjoin(ChatMessage, ChatMessage.id == page.c.message_id)
+        .outerjoin(DocumentChunk, DocumentChunk.id == page.c.chunk_id)
+        .order_by(page.c.score.desc(), page.c.chat_id.desc())
+    )).all()
+
+    return {
+        "items": [{"id": r.chat_id, "title": r.title, "timestamp": r.timestamp.isoformat(),
+                   "matches": r.matches, "source": "message" if r.message_id else "document",
+                   "snippet": r.snippet}
+                  for r in rows[:limit]],
+        "next_offset": offset + limit if len(rows) > limit else None
+    }
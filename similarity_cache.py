@@ -0,0 +1,166 @@
+import os
+import random
+import re
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+SIMILARITY_CACHE_ENABLED = os.environ.get("SIMILARITY_CACHE_ENABLED", "0") == "1"
+SIMILARITY_THRESHOLD = float(os.environ.get("SIMILARITY_THRESHOLD", "0.85"))
+SIMILARITY_CACHE_MAX_ENTRIES = int(os.environ.get("SIMILARITY_CACHE_MAX_ENTRIES", "100000"))
+SIMILARITY_CACHE_TTL = float(os.environ.get("SIMILARITY_CACHE_TTL", "3600"))
+# 8 bands of 4 rows: pairs above ~0.6 Jaccard almost always share a band; the threshold is
+# then checked on the full signature.
+MINHASH_BANDS = int(os.environ.get("MINHASH_BANDS", "8"))
+MINHASH_ROWS = int(os.environ.get("MINHASH_ROWS", "4"))
+SHINGLE_SIZE = 5
+# Only the tail of very long prompts is shingled; it keeps signing cost bounded on the event loop.
+MAX_SHINGLED_CHARS = 4000
+
+_MASK64 = (1 << 64) - 1
+
+
+def normalize(text: str):
+    # Case, punctuation and whitespace differences do not change what is being asked
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", text.lower())).strip()
+
+
+def shingle_hashes(text: str, size: int = SHINGLE_SIZE):
+    text = normalize(text)[-MAX_SHINGLED_CHARS:]
+    if len(text) <= size:
+        return {hash(text)}
+    return {hash(text[i:i + size]) for i in range(len(text) - size + 1)}
+
+
+class MinHasher:
+    """MinHash signatures from multiply-shift hash functions over the shingle hashes."""
+
+    def __init__(self, num_perm: int, seed: int = 1):
+        rng = random.Random(seed)
+        self.params = [(rng.getrandbits(64) | 1, rng.getrandbits(64)) for _ in range(num_perm)]
+
+    def signature(self, hashes):
+        hashes = [h & _MASK64 for h in hashes]
+        return array("I", [min([((a * h + b) & _MASK64) >> 32 for h in hashes]) for a, b in self.params])
+
+
+def estimated_jaccard(sig_a, sig_b):
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+class SimilarityCache:
+    """In-memory near-duplicate answer cache indexed with MinHash LSH.
+
+    Entries live in a partition (provider, model, system prompt, search flag and earlier turns
+    must match exactly) and are looked up by the text of the latest user message alone. A lookup probes one bucket
+    per band and returns the closest candidate, provided its estimated Jaccard similarity
+    reaches the threshold. Entries are evicted least-recently-used beyond `max_size` and on expiry.
+    """
+
+    def __init__(self, threshold: float = SIMILARITY_THRESHOLD, max_size: int = SIMILARITY_CACHE_MAX_ENTRIES,
+                 ttl: float = SIMILARITY_CACHE_TTL, bands: int = MINHASH_BANDS, rows: int = MINHASH_ROWS):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.bands = bands
+        self.rows = rows
+        self.hasher = MinHasher(bands * rows)
+        # entry id -> (partition, signature, value, expires_at), in LRU order
+        self._entries = OrderedDict()
+        # hash of (partition, band index, band values) -> entry id, or a set of ids once shared.
+        # Nearly all buckets hold one entry, so storing the bare id keeps 1M entries in memory.
+        self._buckets = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _band_keys(self, partition, signature):
+        rows = self.rows
+        return [hash((partition, band, *signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+
+    def _remove(self, entry_id):
+        partition, signature, _, _ = self._entries.pop(entry_id)
+        for key in self._band_keys(partition, signature):
+            bucket = self._buckets.get(key)
+            if bucket == entry_id:
+                del self._buckets[key]
+            elif isinstance(bucket, set):
+                bucket.discard(entry_id)
+                if len(bucket) == 1:
+                    self._buckets[key] = bucket.pop()
+
+    def sign(self, text: str):
+        return self.hasher.signature(shingle_hashes(text))
+
+    def get(self, partition, text: str):
+        return self.get_signed(partition, self.sign(text))
+
+    def get_signed(self, partition, signature):
+        now = time.monotonic()
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(partition, signature):
+                bucket = self._buckets.get(key)
+                if isinstance(bucket, set):
+                    candidates.update(bucket)
+                elif bucket is not None:
+                    candidates.add(bucket)
+
+            best_id, best_score = None, self.threshold
+            for entry_id in candidates:
+                entry_partition, entry_signature, _, expires_at = self._entries[entry_id]
+                if expires_at <= now:
+                    self._remove(entry_id)
+                    continue
+                if entry_partition != partition:
+                    continue
+                score = estimated_jaccard(signature, entry_signature)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.counters["hits"] += 1
+            return self._entries[best_id][2]
+
+    def set(self, partition, text: str, value, ttl: float = None):
+        self.set_signed(partition, self.sign(text), value, ttl)
+
+    def set_signed(self, partition, signature, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (sys.intern(partition), signature, value, expires_at)
+            for key in self._band_keys(partition, signature):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    self._buckets[key] = entry_id
+                elif isinstance(bucket, set):
+                    bucket.add(entry_id)
+                else:
+                    self._buckets[key] = {bucket, entry_id}
+            self.counters["stores"] += 1
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {**self.counters, "entries": len(self._entries), "max_entries": self.max_size,
+                "threshold": self.threshold, "hit_ratio": round(self.counters["hits"] / lookups, 4) if lookups else 0.0}
+
+
+similarity_cache = SimilarityCache()
@@ -0,0 +1,49 @@
+# test_scheduler.py
+#   python -m pytest test_scheduler.py   (or python -m unittest test_scheduler)
+import asyncio
+import unittest
+
+from scheduler import Scheduler, INTERACTIVE
+
+
+class CancelVersusReleaseTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancelled_waiter_is_not_given_the_released_slot(self):
+        scheduler = Scheduler({"P": 1})
+        holder_entered = asyncio.Event()
+        release = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot("P", INTERACTIVE):
+                holder_entered.set()
+                await release.wait()
+            return "answered"
+
+        async def waiter():
+            async with scheduler.slot("P", INTERACTIVE):
+                return "ran"
+
+        holder_task = asyncio.create_task(holder())
+        await holder_entered.wait()
+        waiter_task = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        self.assertEqual(len(scheduler.queue_for("P").waiters), 1)
+
+        # The holder leaves its slot and the waiter is cancelled in the same loop step; the holder
+        # runs first and finds the waiter's future already cancelled
+        release.set()
+        waiter_task.cancel()
+
+        self.assertEqual(await holder_task, "answered")
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter_task
+        queue = scheduler.queue_for("P")
+        self.assertEqual(queue.in_flight, 0)
+        self.assertEqual(queue.waiters, [])
+
+        # The provider still takes calls
+        async with scheduler.slot("P", INTERACTIVE):
+            self.assertEqual(queue.in_flight, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()